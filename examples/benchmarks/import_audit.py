@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+    Import-time audit of flask_multiprocess_controller: starts workers with the spawn start method, each importing
+    either the worker-side core only, or the package by a star import as task modules do, or the web layer as well,
+    and prints the time to start, the resident set size and the heavy modules loaded by a worker.
+
+    python -m examples.benchmarks.import_audit --workers 5
+
+    Only the standard library is imported at the top of this module, it is imported again by every spawned worker.
+
+    :copyright: 2022 Yuhao Wang
+    :license: BSD-3-Clause
+"""
+
+import argparse
+import json
+import multiprocessing
+import sys
+import time
+from queue import Empty
+
+# modules a worker should never need
+HEAVY_MODULES = ('flask', 'flask_restful', 'werkzeug', 'requests', 'jinja2', 'urllib3')
+# seconds a worker may take to start and report
+WORKER_TIMEOUT = 60.
+
+
+def _rss_mb() -> float:
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024.
+    return float('nan')
+
+
+def _worker(queue, started: float, case: str) -> None:
+    import_start = time.monotonic()
+    import src.flask_multiprocess_controller
+    if case == 'star':
+        # what a task module starting with `from flask_multiprocess_controller import *` loads
+        exec('from src.flask_multiprocess_controller import *', dict())
+    elif case == 'core+web':
+        # what importing the package used to load in every worker
+        import src.flask_multiprocess_controller.template
+    ready = time.monotonic()
+    queue.put({'startMs': (ready - started) * 1000.,
+               'importMs': (ready - import_start) * 1000.,
+               'rssMb': _rss_mb(),
+               'heavyModules': sorted({name.split('.')[0] for name in sys.modules} & set(HEAVY_MODULES))})
+
+
+def _collect(queue, process, case: str) -> dict:
+    """
+    wait for the report of a worker, exit with an error if it died or hangs without reporting
+    """
+    deadline = time.monotonic() + WORKER_TIMEOUT
+    while True:
+        # the report is flushed before the worker exits, look for it once more after it exited
+        exited = process.exitcode is not None
+        try:
+            return queue.get(timeout=1.)
+        except Empty:
+            if not exited and time.monotonic() < deadline:
+                continue
+        if process.is_alive():
+            process.kill()
+        process.join()
+        print("{} worker exited with code {} without reporting".format(case, process.exitcode), file=sys.stderr)
+        sys.exit(1)
+
+
+def _audit(context, case: str, num_workers: int) -> dict:
+    queue = context.Queue()
+    results = list()
+    for _ in range(num_workers):
+        process = context.Process(target=_worker, args=(queue, time.monotonic(), case))
+        process.start()
+        results.append(_collect(queue, process, case))
+        process.join()
+    return {'startMs': sum(result['startMs'] for result in results) / num_workers,
+            'importMs': sum(result['importMs'] for result in results) / num_workers,
+            'rssMb': sum(result['rssMb'] for result in results) / num_workers,
+            'heavyModules': results[-1]['heavyModules']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=5, help="number of workers started for each case")
+    parser.add_argument('--start-method', choices=('spawn', 'forkserver'), default='spawn')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context(args.start_method)
+    report = {case: _audit(context, case, args.workers) for case in ('core', 'star', 'core+web')}
+    print(json.dumps(report, indent=2))
+    # the star import exports the web layer, and loads it, only the explicit import must stay light
+    if report['core']['heavyModules']:
+        print("workers import {}".format(', '.join(report['core']['heavyModules'])), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+    Regression checks of the scheduling policies of MPController on the simulated backend, for CI: every scenario
+    runs with a fixed seed, so its outcome is exact and compared to the expected one, the script exits with an error
+    on the first mismatch.
+
+    python -m examples.benchmarks.scheduling_regression
+
+    Update the expected values only along with a deliberate change of the scheduling.
+
+    :copyright: 2022 Yuhao Wang
+    :license: BSD-3-Clause
+"""
+
+import logging
+import random
+from src.flask_multiprocess_controller import MetaMPTask, ProcessBudget, SimulatedBackend, TemplateFactory
+
+
+class SimulatedTask(MetaMPTask):
+
+    def execute(self, *args, **kwargs) -> None:
+        # never executed by the simulated backend
+        pass
+
+
+def check_shared_budget_with_preemption() -> None:
+    """
+    two controllers sharing a budget under a Poisson stream of tickets, some of them urgent and preempting
+    """
+    backend = SimulatedBackend(duration=SimulatedBackend.exponential(1.), seed=0)
+    budget = ProcessBudget(8)
+    main_controller = TemplateFactory.MPController('Main')(
+        target_task=SimulatedTask, max_num_process=7, budget=budget, budget_weight=3, queue_timeout=20.,
+        preemption_priority=-1, backend=backend)
+    report_controller = TemplateFactory.MPController('Report')(
+        target_task=SimulatedTask, max_num_process=8, budget=budget, budget_minimum=1, queue_timeout=20.,
+        backend=backend)
+    rng = random.Random(0)
+    arrival = 0.
+    for _ in range(5000):
+        arrival += rng.expovariate(0.95 * 8)
+        controller = main_controller if rng.random() < 0.75 else report_controller
+        priority = -1 if controller is main_controller and rng.random() < 0.1 else 0
+        backend.submit(controller, at=arrival, priority=priority)
+    report = backend.run()
+    observed = {'states': report['states'],
+                'finished': {name: controller['finished'] for name, controller in report['controllers'].items()},
+                'preemptions': main_controller.metrics()['preemptionCounter'],
+                'fairness': round(report['fairness'], 3),
+                'queueWaitP90': round(report['queueWait']['p90'], 3)}
+    _expect('shared budget with preemption', observed,
+            {'states': {'finished': 5000}, 'finished': {'Main': 3729, 'Report': 1271}, 'preemptions': 36,
+             'fairness': 1.0, 'queueWaitP90': 11.769})
+
+
+def check_borrowing_past_a_capped_controller() -> None:
+    """
+    a controller capped below its share by max_num_process leaves its slots to the other one
+    """
+    backend = SimulatedBackend(duration=SimulatedBackend.constant(1.))
+    budget = ProcessBudget(8)
+    wide_controller = TemplateFactory.MPController('Wide')(
+        target_task=SimulatedTask, max_num_process=8, budget=budget, backend=backend)
+    narrow_controller = TemplateFactory.MPController('Narrow')(
+        target_task=SimulatedTask, max_num_process=1, budget=budget, backend=backend)
+    for _ in range(210):
+        backend.submit(wide_controller, at=0.)
+    for _ in range(30):
+        backend.submit(narrow_controller, at=0.)
+    report = backend.run()
+    # 7 slots for the wide controller: its last tickets are dispatched at 29
+    observed = {'states': report['states'], 'wideMaxQueueWait': report['controllers']['Wide']['queueWait']['max']}
+    _expect('borrowing past a capped controller', observed, {'states': {'finished': 240}, 'wideMaxQueueWait': 29.})
+
+
+def check_deadline_paused_while_suspended() -> None:
+    """
+    a suspended ticket does not time out, a ticket finishing within the stop latency is recorded as finished
+    """
+    backend = SimulatedBackend(duration=SimulatedBackend.from_kwargs(), stop_latency=0.5)
+    controller = TemplateFactory.MPController('Deadline')(
+        target_task=SimulatedTask, max_num_process=1, preemption_priority=-1, backend=backend)
+    # suspended from 1 to 6 by the urgent ticket, then runs its last second before its 3s of run time
+    backend.submit(controller, at=0., duration=2., timeout=3.)
+    backend.submit(controller, at=1., duration=5., priority=-1)
+    # stopped at 1, would have finished at 1.2, within the stop latency
+    backend.submit(controller, at=7., duration=1.2, timeout=1.)
+    # stopped at 1, ends 0.5 later
+    backend.submit(controller, at=9., duration=3., timeout=1.)
+    report = backend.run()
+    _expect('deadline paused while suspended', {'states': report['states']},
+            {'states': {'finished': 3, 'timeout': 1}})
+
+
+def check_requeue_into_a_full_queue() -> None:
+    """
+    a ticket preempted with the requeue policy goes back to a bounded queue filled by the urgent ticket
+    """
+    backend = SimulatedBackend(duration=SimulatedBackend.from_kwargs())
+    controller = TemplateFactory.MPController('Requeue')(
+        target_task=SimulatedTask, max_num_process=1, max_num_queue=1, preemption_priority=-1,
+        preemption_policy='requeue', backend=backend)
+    backend.submit(controller, at=0., duration=5.)
+    backend.submit(controller, at=1., duration=2., priority=-1)
+    report = backend.run()
+    observed = {'states': report['states'], 'preemptions': controller.metrics()['preemptionCounter']}
+    _expect('requeue into a full queue', observed, {'states': {'finished': 2}, 'preemptions': 1})
+
+
+def _expect(scenario: str, observed: dict, expected: dict) -> None:
+    assert observed == expected, "{}: expected {}, observed {}".format(scenario, expected, observed)
+    print("{}: ok".format(scenario))
+
+
+def main():
+    # every expired ticket is logged as a warning
+    logging.disable(logging.WARNING)
+    check_shared_budget_with_preemption()
+    check_borrowing_past_a_capped_controller()
+    check_deadline_paused_while_suspended()
+    check_requeue_into_a_full_queue()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+    Benchmark of the scheduling policies of MPController on the simulated backend: two controllers sharing a
+    process budget receive a Poisson stream of tickets with exponential durations, some of them urgent, and the
+    throughput, fairness and queue-wait percentiles are printed as JSON.
+
+    python -m examples.benchmarks.simulate_scheduling --tickets 100000
+
+    :copyright: 2022 Yuhao Wang
+    :license: BSD-3-Clause
+"""
+
+import argparse
+import json
+import logging
+import random
+import time
+from src.flask_multiprocess_controller import MetaMPTask, ProcessBudget, SimulatedBackend, TemplateFactory
+
+
+class SimulatedTask(MetaMPTask):
+
+    def execute(self, *args, **kwargs) -> None:
+        # never executed by the simulated backend
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tickets', type=int, default=100000, help="number of tickets posted")
+    parser.add_argument('--processes', type=int, default=8, help="size of the shared process budget")
+    parser.add_argument('--load', type=float, default=0.9, help="offered load, relative to the budget")
+    parser.add_argument('--mean-duration', type=float, default=1., help="mean run time of a ticket")
+    parser.add_argument('--urgent', type=float, default=0.1, help="share of the urgent tickets")
+    parser.add_argument('--policy', choices=('suspend', 'requeue'), default='suspend', help="preemption policy")
+    parser.add_argument('--queue-timeout', type=float, default=None, help="queue deadline of the tickets")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # every expired ticket is logged as a warning
+    logging.disable(logging.WARNING)
+    backend = SimulatedBackend(duration=SimulatedBackend.exponential(args.mean_duration), seed=args.seed)
+    budget = ProcessBudget(args.processes)
+    main_controller = TemplateFactory.MPController('Main')(
+        target_task=SimulatedTask, max_num_process=args.processes - 1, budget=budget, budget_weight=3,
+        queue_timeout=args.queue_timeout, preemption_priority=-1, preemption_policy=args.policy, backend=backend)
+    report_controller = TemplateFactory.MPController('Report')(
+        target_task=SimulatedTask, max_num_process=args.processes, budget=budget, budget_minimum=1,
+        queue_timeout=args.queue_timeout, backend=backend)
+
+    arrival_rate = args.load * args.processes / args.mean_duration
+    rng = random.Random(args.seed)
+    arrival = 0.
+    for _ in range(args.tickets):
+        arrival += rng.expovariate(arrival_rate)
+        controller = main_controller if rng.random() < 0.75 else report_controller
+        priority = -1 if controller is main_controller and rng.random() < args.urgent else 0
+        backend.submit(controller, at=arrival, priority=priority)
+
+    start_time = time.perf_counter()
+    report = backend.run()
+    report.update({'wallTime': time.perf_counter() - start_time,
+                   'preemptions': main_controller.metrics()['preemptionCounter']})
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
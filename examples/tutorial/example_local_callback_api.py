@@ -10,7 +10,7 @@
 import os
 import logging
 from flask_restful import Api
-from src.flask_multiprocess_controller import *
+from src.flask_multiprocess_controller import MetaMPController, TemplateFactory
 
 
 # Here also shows that if multiprocess controller isn't needed (e.g. performing simple tasks), one can override the
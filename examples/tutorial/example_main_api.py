@@ -11,7 +11,7 @@ import os
 import logging
 import time
 from flask_restful import Api
-from src.flask_multiprocess_controller import *
+from src.flask_multiprocess_controller import MetaMPTask, TemplateFactory
 
 
 class MainTask(MetaMPTask):
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+    The example implementation of a controller running its tasks on remote worker agents.
+
+    start the server: MP_AGENT_AUTHKEY=secret gunicorn 'example_remote_agents:create_app()'
+    start an agent on each compute node, from this directory:
+        MP_AGENT_AUTHKEY=secret python -m src.flask_multiprocess_controller.agent <server-host>:6000 --capacity 2
+
+    The agents unpickle the task class by reference, so RemoteTask is kept in a module that the agents can import and
+    that does not import Flask at the top.
+
+    :copyright: 2022 Yuhao Wang
+    :license: BSD-3-Clause
+"""
+
+import os
+import logging
+import socket
+import time
+from src.flask_multiprocess_controller import AgentBackend, MetaMPTask
+
+
+class RemoteTask(MetaMPTask):
+
+    def execute(self, *args, **kwargs) -> None:
+        task_logger = logging.getLogger("Remote-" + str(os.getpid()))
+        task_logger.info("REMOTE_TASK runs on {} with param: {}".format(socket.gethostname(), kwargs))
+        counter = 0
+        while counter < 20:
+            counter += 1
+            time.sleep(0.5)
+            # the progress and the logs are streamed back to the controller by the agent
+            self.upload_status(counter * 5)
+            self.set_checkpoint()
+        task_logger.info("Execution Finished!")
+
+
+def create_app():
+    """
+    gunicorn way to start the server, use a single worker for the agents connect to one controller
+    command: gunicorn 'example_remote_agents:create_app()'
+    :return:
+    """
+    import flask
+    from flask_restful import Api
+    from src.flask_multiprocess_controller import TemplateFactory
+    remote_api = Api()
+    # the agents connect on port 6000, tickets wait in the queue until an agent has a free slot
+    backend = AgentBackend(('0.0.0.0', 6000), authkey=os.environ['MP_AGENT_AUTHKEY'].encode(), lease_timeout=10.)
+    remote_controller = TemplateFactory.MPController(name='Remote')(
+        target_task=RemoteTask, max_num_process=16, task_timeout=600., backend=backend)
+    remote_api.add_resource(TemplateFactory.MPResource(), '/remote', resource_class_args=(remote_controller,))
+    app = flask.Flask(__name__)
+    remote_api.init_app(app)
+    return app
+
+
+if __name__ == '__main__':
+    # import the module by name, RemoteTask defined in __main__ could not be imported by the agents
+    from example_remote_agents import create_app as _create_app
+    _create_app().run(host='0.0.0.0', port=8050)
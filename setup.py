@@ -117,6 +117,9 @@ setup(
         'Werkzeug~=1.0',
         'flask_restful~=0.3'
     ],
+    extras_require={
+        'fast': ['orjson', 'msgpack'],
+    },
     classifiers=[
         'Environment :: Web Environment',
         'Intended Audience :: Developers',
@@ -10,12 +10,33 @@
     :license: BSD-3-Clause
 """
 
+import importlib
+from typing import TYPE_CHECKING
+
+# worker-side core, the only part a worker process needs, imports nothing but the standard library
 from .task import MetaMPTask
-from .controller import MetaMPController
-from .resource import MetaMPResource
 from .utils import upload_status, set_checkpoint, AbortException
-from .template import TemplateFactory
 from .logger import MetaMPLoggerConfigurator
+from .payload import PayloadHandle
+from .dataset import DatasetHandle
+from .budget import ProcessBudget
+from .backend import MetaMPBackend, SimulatedBackend
+from .agent import AgentBackend, WorkerAgent
+
+# web layer, depending on Flask, flask_restful and werkzeug, imported on first access only so that the workers
+# started with spawn or forkserver, which import this package again, do not load it
+# `from flask_multiprocess_controller import *` still exports it and loads it, a task module run by the workers
+# should import the names it uses explicitly
+_LAZY_ATTRIBUTES = {
+    'MetaMPController': '.controller',
+    'MetaMPResource': '.resource',
+    'TemplateFactory': '.template',
+}
+
+if TYPE_CHECKING:
+    from .controller import MetaMPController
+    from .resource import MetaMPResource
+    from .template import TemplateFactory
 
 __version__ = '0.1.1'
 
@@ -27,5 +48,24 @@ __all__ = [
     'set_checkpoint',
     'AbortException',
     'MetaMPLoggerConfigurator',
+    'PayloadHandle',
+    'DatasetHandle',
+    'ProcessBudget',
+    'MetaMPBackend',
+    'SimulatedBackend',
+    'AgentBackend',
+    'WorkerAgent',
     'TemplateFactory'
 ]
+
+
+def __getattr__(name: str):
+    if name in _LAZY_ATTRIBUTES:
+        value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
@@ -0,0 +1,544 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_multiprocess_controller.agent
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module implements remote worker agents, letting one MPController run its tickets on several hosts:
+
+    - AgentBackend, the backend of the controller, listens for agents over TCP or a Unix socket and leases them the
+      tickets of the waiting queue
+    - WorkerAgent runs on each compute node, registers its capacity and runs the leased tickets in local processes,
+      streaming their progress and logs back and following the stop, suspend and resume requests of the controller
+
+    Every agent keeps one connection to the controller, carrying tagged messages both ways. An agent silent for
+    lease_timeout seconds, or whose connection drops, is lost and its tickets are put back in the queue.
+
+    Only the worker-side core of the package is imported here, an agent never loads Flask.
+
+    :copyright: 2022 Yuhao Wang
+    :license: BSD-3-Clause
+"""
+
+import argparse
+import itertools
+import logging
+import multiprocessing
+import os
+import pickle
+import signal
+import socket
+import threading
+import time
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+from .backend import MetaMPBackend
+from .dataset import DatasetHandle
+from .logger import MetaMPLoggerConfigurator, DefaultMPLoggerConfigurator
+from .task import MetaMPTask
+from .utils import get_process_groups, get_process_group_rss, signal_process_group
+
+logger = logging.getLogger(__name__)
+
+
+class _RemoteAgent(object):
+    """
+    an agent connected to the AgentBackend
+    """
+
+    def __init__(self, connection: Connection, name: str, capacity: int):
+        self.connection: Connection = connection
+        self.name: str = name
+        self.capacity: int = capacity
+        self.last_seen: float = time.time()
+        # leases held by the agent, and the suspended ones among them, which do not take a slot
+        self.leases: Set[int] = set()
+        self.suspended: Set[int] = set()
+        self.send_lock = threading.Lock()
+
+    @property
+    def load(self) -> float:
+        return (len(self.leases) - len(self.suspended)) / self.capacity
+
+
+class _Lease(object):
+    """
+    a ticket leased to an agent
+    """
+
+    def __init__(self, task_uuid: str, target_task: type, kwargs: dict, agent_id: Optional[int],
+                 datasets: Dict[str, DatasetHandle]):
+        self.task_uuid: str = task_uuid
+        self.target_task: type = target_task
+        self.kwargs: dict = kwargs
+        self.agent_id: Optional[int] = agent_id
+        # versions of the shared datasets pinned for the whole run, released when the lease ends
+        self.datasets: Dict[str, DatasetHandle] = datasets
+
+
+class AgentBackend(MetaMPBackend):
+    """
+    backend of a MetaMPController running its tickets on remote WorkerAgents
+
+    - the capacity of the controller is the total capacity of the connected agents, capped by max_num_process
+    - a dispatched ticket is leased to the least loaded agent, its task class is pickled by reference and has to be
+      importable on the agent
+    - pipelines, sharded jobs, datasets and snapshots pass files to the tasks, they need a directory shared with the
+      agents
+    - the tasks get the num_threads of the controller, their core budget is the share of the agent's cpus of each
+      slot, cpu_affinity of the controller does not apply to them
+    """
+
+    def __init__(self, address: Union[Tuple[str, int], str], authkey: bytes, heartbeat_interval: float = 1.,
+                 lease_timeout: float = 10.):
+        """
+        :param address: (host, port) to listen on TCP, or the path of a Unix socket
+        :param authkey: secret shared with the agents, connections without it are refused
+        :param heartbeat_interval: how often the agents send a heartbeat and the leases are checked, in seconds
+        :param lease_timeout: an agent silent for this many seconds is lost, its tickets are put back in the queue
+        """
+        assert lease_timeout > heartbeat_interval, "lease_timeout should be greater than heartbeat_interval"
+        self._listener = Listener(address, authkey=authkey)
+        self.address = self._listener.address
+        self.heartbeat_interval: float = heartbeat_interval
+        self.lease_timeout: float = lease_timeout
+        self._controller = None
+        self._lock = threading.RLock()
+        self._agent_ids = itertools.count(1)
+        self._lease_ids = itertools.count(1)
+        self._agents: Dict[int, _RemoteAgent] = dict()
+        self._leases: Dict[int, _Lease] = dict()
+
+    def bind(self, controller) -> None:
+        assert self._controller is None, "an AgentBackend serves a single controller"
+        self._controller = controller
+        controller._start_threads()
+        threading.Thread(target=self._accepting, daemon=True, name='AgentListener').start()
+        threading.Thread(target=self._watching_leases, daemon=True, name='LeaseWatcher').start()
+
+    def capacity(self, controller) -> int:
+        with self._lock:
+            return sum(agent.capacity for agent in self._agents.values())
+
+    def agents(self) -> dict:
+        """
+        :return: agent name -> capacity and number of leases held
+        """
+        with self._lock:
+            return {agent.name: {'capacity': agent.capacity, 'leases': len(agent.leases),
+                                 'suspended': len(agent.suspended)}
+                    for agent in self._agents.values()}
+
+    def _send(self, agent: _RemoteAgent, message: tuple) -> bool:
+        try:
+            with agent.send_lock:
+                agent.connection.send(message)
+            return True
+        except (OSError, ValueError, EOFError) as e:
+            logger.warning("failed to send {} to agent {}: {}".format(message[0], agent.name, e))
+            return False
+
+    def _accepting(self) -> None:
+        """
+        accept the agents, each one is then served by its own thread
+        :return:
+        """
+        while True:
+            try:
+                connection = self._listener.accept()
+            except (OSError, EOFError, multiprocessing.AuthenticationError) as e:
+                logger.warning("agent connection refused: {}".format(e))
+                continue
+            threading.Thread(target=self._serving, args=(connection,), daemon=True, name='AgentConnection').start()
+
+    def _serving(self, connection: Connection) -> None:
+        """
+        register an agent and handle its messages until its connection drops
+        :param connection: connection of the agent
+        :return:
+        """
+        try:
+            kind, name, capacity = connection.recv()
+            assert kind == 'register' and capacity > 0
+        except Exception as e:
+            logger.warning("agent failed to register: {}".format(e))
+            connection.close()
+            return
+        agent = _RemoteAgent(connection, name, int(capacity))
+        with self._lock:
+            agent_id = next(self._agent_ids)
+            self._agents.update({agent_id: agent})
+        logger.info("agent {} registered with capacity {}".format(name, capacity))
+        self._controller._waiting_queue_intake_event.set()
+        while agent_id in self._agents:
+            try:
+                message = connection.recv()
+            except (EOFError, OSError):
+                break
+            except Exception as e:
+                # the connection is closed under this thread when the agent is lost
+                if agent_id not in self._agents:
+                    break
+                logger.warning("failed to read a message of agent {}: {}".format(name, e))
+                continue
+            agent.last_seen = time.time()
+            kind = message[0]
+            if kind == 'progress':
+                if message[1] in self._leases:
+                    self._controller._process_progress.update({message[1]: message[2]})
+            elif kind == 'log':
+                self._controller._log_queue.put_nowait(message[1])
+            elif kind == 'ended':
+                self._end(*message[1:])
+            elif kind == 'started':
+                logger.debug("lease {} started on agent {} as process {}".format(message[1], name, message[2]))
+        self._lose_agent(agent_id)
+
+    def _watching_leases(self) -> None:
+        """
+        periodically drop the agents silent for too long and stop the tickets past their run time deadline
+        :return:
+        """
+        while True:
+            time.sleep(self.heartbeat_interval)
+            now = time.time()
+            with self._lock:
+                lost = [agent_id for agent_id, agent in self._agents.items()
+                        if now - agent.last_seen > self.lease_timeout]
+                expired = [lease_id for lease_id in self._leases if self._controller._run_deadline_passed(lease_id)]
+                orphans = [lease_id for lease_id, lease in self._leases.items() if lease.agent_id is None]
+            for agent_id in lost:
+                self._lose_agent(agent_id, "missed its heartbeats for {}s".format(self.lease_timeout))
+            for lease_id in expired:
+                self._controller._request_stop(lease_id, 'timeout')
+            for lease_id in orphans:
+                self._end(lease_id, None, None, None)
+
+    def _lose_agent(self, agent_id: int, reason: str = None) -> None:
+        """
+        drop an agent, the tickets it holds end as `lost` and are put back in the queue
+        :param agent_id: the agent to drop, nothing is done if it is already dropped
+        :param reason: why the agent is dropped, logged with its name
+        :return:
+        """
+        with self._lock:
+            agent = self._agents.pop(agent_id, None)
+            if agent is None:
+                return
+            for lease_id in agent.leases:
+                self._leases[lease_id].agent_id = None
+        if reason is not None:
+            logger.warning("agent {} {}.".format(agent.name, reason))
+        logger.warning("agent {} lost with {} tickets.".format(agent.name, len(agent.leases)))
+        # shut the socket down first to wake the thread reading it up, the agent stops its tasks once it sees it
+        try:
+            with socket.socket(fileno=os.dup(agent.connection.fileno())) as agent_socket:
+                agent_socket.shutdown(socket.SHUT_RDWR)
+            agent.connection.close()
+        except (OSError, ValueError):
+            pass
+        for lease_id in list(agent.leases):
+            self._end(lease_id, None, None, None)
+
+    def launch(self, controller, task_uuid: str, target_task: type, kwargs: dict) -> int:
+        task_context = controller._task_context(task_uuid, target_task, kwargs)
+        # the agent maps the dataset files from the shared spool directory, see WorkerAgent._running
+        datasets = controller._datasets.acquire()
+        task_context.update({'datasets': datasets, 'num_threads': controller._num_threads})
+        with self._lock:
+            lease_id = next(self._lease_ids)
+            agent_id = min(self._agents, key=lambda candidate: self._agents[candidate].load, default=None)
+            lease = _Lease(task_uuid, target_task, kwargs, agent_id, datasets)
+            self._leases.update({lease_id: lease})
+            controller._start_run_deadline(lease_id, kwargs)
+            controller._process_record.update({lease_id: None})
+            controller._control_relationship.update({lease_id: lease_id})
+            if agent_id is not None:
+                self._agents[agent_id].leases.add(lease_id)
+        # a ticket without an agent, or that could not be sent, is lost at the next check of the leases
+        # the ticket is pickled apart, so that the agent can report a task it fails to load
+        try:
+            ticket = pickle.dumps((target_task, kwargs, task_context))
+        except Exception as e:
+            logger.error("failed to pickle the ticket {}: {}".format(task_uuid, e))
+            ticket = pickle.dumps((None, kwargs, task_context))
+        if agent_id is not None and not self._send(self._agents[agent_id], (
+                'run', lease_id, ticket, controller._termination_grace_period)):
+            lease.agent_id = None
+        return lease_id
+
+    def _agent_of(self, lease_id: int) -> Optional[_RemoteAgent]:
+        with self._lock:
+            lease = self._leases.get(lease_id)
+            return self._agents.get(lease.agent_id) if lease is not None else None
+
+    def request_stop(self, controller, pid: int) -> None:
+        agent = self._agent_of(pid)
+        if agent is not None:
+            self._send(agent, ('stop', pid))
+
+    def suspend(self, controller, pid: int) -> None:
+        agent = self._agent_of(pid)
+        if agent is not None:
+            agent.suspended.add(pid)
+            self._send(agent, ('suspend', pid))
+
+    def resume(self, controller, pid: int) -> None:
+        agent = self._agent_of(pid)
+        if agent is not None:
+            agent.suspended.discard(pid)
+            self._send(agent, ('resume', pid))
+
+    def _end(self, lease_id: int, exit_code: Optional[int], escalation: Optional[int],
+             peak_rss: Optional[int]) -> None:
+        """
+        end a lease, either reported by its agent or lost with it
+        :param lease_id: the lease
+        :param exit_code: exit code of the process, None if the lease is lost
+        :param escalation: escalation step the agent reached on the stop request, None if there was none
+        :param peak_rss: peak resident set size of the process in bytes
+        :return:
+        """
+        with self._lock:
+            lease = self._leases.pop(lease_id, None)
+            if lease is None:
+                return
+            agent = self._agents.get(lease.agent_id)
+            if agent is not None:
+                agent.leases.discard(lease_id)
+                agent.suspended.discard(lease_id)
+        controller = self._controller
+        controller._process_record.pop(lease_id, None)
+        controller._process_progress.pop(lease_id, None)
+        controller._control_relationship.pop(lease_id, None)
+        controller._clear_run_deadline(lease_id)
+        controller._datasets.release(lease.datasets)
+        stop_request = controller._stop_requests.pop(lease_id, None)
+        if exit_code is None:
+            # a ticket stopped on purpose is not requeued
+            final_state = {'state': stop_request[1] if stop_request is not None else 'lost', 'exitCode': None,
+                           'escalation': None}
+        else:
+            # the agent escalates the stop requests itself
+            if stop_request is not None and escalation is not None:
+                stop_request[2] = escalation
+            final_state = controller._final_state(exit_code, stop_request)
+        final_state.update({'peakRssMb': controller._to_mb(peak_rss)})
+        controller._release_ticket(lease.task_uuid, lease.target_task, lease.kwargs, final_state)
+
+
+class WorkerAgent(object):
+    """
+    process on a compute node running the tickets leased by an AgentBackend, each one in its own local process
+
+    the agent stops its processes if its connection to the controller drops, the controller queues their tickets
+    again
+    """
+
+    # how often the agent reads the progress of its processes and escalates the stop requests, in seconds
+    _SUPERVISE_INTERVAL: float = 0.5
+
+    def __init__(self, address: Union[Tuple[str, int], str], authkey: bytes, capacity: int = None,
+                 name: str = None, heartbeat_interval: float = 1.,
+                 logger_configurator_cls: type(MetaMPLoggerConfigurator) = DefaultMPLoggerConfigurator):
+        """
+        :param address: address the AgentBackend listens on
+        :param authkey: secret shared with the controller
+        :param capacity: number of tickets run at once, the number of cpus by default
+        :param name: name reported to the controller, <host>-<pid> by default
+        :param heartbeat_interval: how often a heartbeat is sent, in seconds, below the lease_timeout of the backend
+        :param logger_configurator_cls: log configurator of the task processes, their logs go to the controller
+        """
+        self.address = address
+        self._authkey: bytes = authkey
+        self.capacity: int = capacity or os.cpu_count() or 1
+        self.name: str = name or '{}-{}'.format(socket.gethostname(), os.getpid())
+        self.heartbeat_interval: float = heartbeat_interval
+        self._log_configurator = logger_configurator_cls
+        self._log_queue = multiprocessing.Queue(-1)
+        self._connection: Optional[Connection] = None
+        self._send_lock = threading.Lock()
+        self._closed = threading.Event()
+        # lease id -> [process (None until started), stop event, time the stop was requested, escalation level]
+        self._processes: Dict[int, list] = dict()
+
+    def _send(self, message: tuple) -> None:
+        try:
+            with self._send_lock:
+                self._connection.send(message)
+        except (OSError, ValueError, EOFError):
+            self._closed.set()
+
+    def serve_forever(self) -> None:
+        """
+        connect to the controller and run the leased tickets until the connection drops
+        :return:
+        """
+        self._connection = Client(self.address, authkey=self._authkey)
+        self._closed.clear()
+        self._send(('register', self.name, self.capacity))
+        logger.info("agent {} connected to {} with capacity {}".format(self.name, self.address, self.capacity))
+        threading.Thread(target=self._beating, daemon=True, name='AgentHeartbeat').start()
+        threading.Thread(target=self._forwarding_log, daemon=True, name='AgentLogForwarder').start()
+        while not self._closed.is_set():
+            try:
+                message = self._connection.recv()
+            except (EOFError, OSError):
+                break
+            kind, lease_id = message[0], message[1]
+            if kind == 'run':
+                self._processes.update({lease_id: [None, multiprocessing.Event(), None, None]})
+                threading.Thread(target=self._running, args=message[1:], daemon=True, name='AgentTask').start()
+            elif kind == 'stop':
+                self._request_stop(lease_id)
+            elif kind in ('suspend', 'resume'):
+                self._signal(lease_id, signal.SIGSTOP if kind == 'suspend' else signal.SIGCONT)
+        self._closed.set()
+        logger.warning("agent {} disconnected, stopping {} tasks.".format(self.name, len(self._processes)))
+        for lease_id in list(self._processes):
+            self._request_stop(lease_id)
+            self._signal(lease_id, signal.SIGCONT)
+        self._connection.close()
+
+    def _beating(self) -> None:
+        while not self._closed.wait(self.heartbeat_interval):
+            self._send(('heartbeat', None))
+
+    def _forwarding_log(self) -> None:
+        while not self._closed.is_set():
+            try:
+                record = self._log_queue.get(timeout=self.heartbeat_interval)
+            except Exception:
+                continue
+            self._send(('log', record))
+
+    def _request_stop(self, lease_id: int) -> None:
+        process_info = self._processes.get(lease_id)
+        if process_info is None or process_info[2] is not None:
+            return
+        process_info[1].set()
+        process_info[2], process_info[3] = time.time(), 0
+
+    def _signal(self, lease_id: int, signal_number: int) -> None:
+        process_info = self._processes.get(lease_id)
+        if process_info is None or process_info[0] is None:
+            return
+        signal_process_group(process_info[0].pid, signal_number)
+
+    def _escalate_stop(self, process_info: list, grace_period: float) -> None:
+        process, _, requested_time, level = process_info
+        if requested_time is None:
+            return
+        elapsed = time.time() - requested_time
+        if level == 0 and elapsed >= grace_period:
+            signal_process_group(process.pid, signal.SIGTERM)
+            process_info[3] = 1
+        elif level == 1 and elapsed >= 2 * grace_period:
+            signal_process_group(process.pid, signal.SIGKILL)
+            process_info[3] = 2
+
+    def _running(self, lease_id: int, ticket: bytes, grace_period: float) -> None:
+        """
+        run a leased ticket in a local process, report its progress and its end to the controller
+        :param lease_id: the lease
+        :param ticket: pickled task class, kwargs of the ticket and kwargs of the task object besides its primitives,
+        see MetaMPController._task_context
+        :param grace_period: seconds between the escalation steps of a stop request
+        :return:
+        """
+        process_info = self._processes[lease_id]
+        parent_connection, child_connection = multiprocessing.Pipe(duplex=False)
+        new_lock = multiprocessing.Lock()
+        exit_code, peak_rss = 1, None
+        try:
+            target_task, kwargs, task_context = pickle.loads(ticket)
+            assert isinstance(target_task, type) and issubclass(target_task, MetaMPTask), \
+                "Invalid class {}, target_task must inherit from MetaMPTask".format(target_task)
+            target_task.counter += 1
+            # the cpus of this host are shared by the slots of the agent
+            task_context.setdefault('core_budget', max(1, (os.cpu_count() or 1) // self.capacity))
+            task_obj = target_task(process_info[1], child_connection, new_lock, self._log_queue, target_task.counter,
+                                   self._log_configurator, **task_context)
+            new_process = multiprocessing.Process(target=task_obj.run,
+                                                  name=str(task_obj.task_name) + '-' + str(target_task.counter),
+                                                  kwargs=kwargs, daemon=True)
+            new_process.start()
+            # the task leads a process group of its own along with its sub-workers, see MetaMPTask.run
+            try:
+                os.setpgid(new_process.pid, new_process.pid)
+            except OSError:
+                pass
+            process_info[0] = new_process
+            self._send(('started', lease_id, new_process.pid))
+            while True:
+                new_process.join(self._SUPERVISE_INTERVAL)
+                progress_list = list()
+                # the process may be suspended while holding the Lock
+                if new_lock.acquire(timeout=self._SUPERVISE_INTERVAL):
+                    try:
+                        while parent_connection.poll():
+                            progress_list.append(parent_connection.recv())
+                    finally:
+                        new_lock.release()
+                if progress_list:
+                    self._send(('progress', lease_id, max(progress_list)))
+                rss = get_process_group_rss(new_process.pid, get_process_groups([new_process.pid])[new_process.pid])
+                if rss is not None:
+                    peak_rss = max(rss, peak_rss or 0)
+                if not new_process.is_alive():
+                    break
+                self._escalate_stop(process_info, grace_period)
+            exit_code = new_process.exitcode
+            # sub-workers never outlive their task
+            try:
+                os.killpg(new_process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        except Exception as e:
+            logger.exception("agent {} failed to run lease {}: {}".format(self.name, lease_id, e))
+        finally:
+            parent_connection.close()
+            self._processes.pop(lease_id, None)
+        self._send(('ended', lease_id, exit_code, process_info[3], peak_rss))
+
+
+def _parse_address(address: str) -> Union[Tuple[str, int], str]:
+    """
+    :param address: <host>:<port>, or the path of a Unix socket
+    :return: address for multiprocessing.connection
+    """
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        return host, int(port)
+    return address
+
+
+def main(argv: List[str] = None) -> None:
+    """
+    command line entry point of an agent, the secret shared with the controller is read from MP_AGENT_AUTHKEY
+    :param argv: command line arguments
+    :return:
+    """
+    parser = argparse.ArgumentParser(description="worker agent of a flask_multiprocess_controller AgentBackend")
+    parser.add_argument('address', help="<host>:<port> or Unix socket path the controller listens on")
+    parser.add_argument('--capacity', type=int, default=None, help="tickets run at once, number of cpus by default")
+    parser.add_argument('--name', default=None, help="name reported to the controller")
+    parser.add_argument('--heartbeat-interval', type=float, default=1.)
+    parser.add_argument('--reconnect-interval', type=float, default=5.,
+                        help="seconds between two connection attempts")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    authkey = os.environ.get('MP_AGENT_AUTHKEY')
+    assert authkey, "MP_AGENT_AUTHKEY is not set"
+    agent = WorkerAgent(_parse_address(args.address), authkey.encode(), capacity=args.capacity, name=args.name,
+                        heartbeat_interval=args.heartbeat_interval)
+    while True:
+        try:
+            agent.serve_forever()
+        except (ConnectionError, OSError, multiprocessing.AuthenticationError) as e:
+            logger.warning("agent {} failed to connect to {}: {}".format(agent.name, agent.address, e))
+        time.sleep(args.reconnect_interval)
+
+
+if __name__ == '__main__':
+    main()
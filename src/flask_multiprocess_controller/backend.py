@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_multiprocess_controller.backend
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module implements the execution backends of MPController: the multiprocessing backend running every ticket
+    in its own process, and a simulated backend running the tickets as virtual-time stubs, to test and benchmark the
+    scheduling policies of the controller at scale without spawning anything.
+
+    :copyright: 2022 Yuhao Wang
+    :license: BSD-3-Clause
+"""
+
+import abc
+import heapq
+import itertools
+import math
+import random
+import signal
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from .utils import ABORT_EXIT_CODE, signal_process_group
+
+
+class MetaMPBackend(metaclass=abc.ABCMeta):
+    """
+    abstract meta class for the execution backend of a MetaMPController, the controller keeps the queue, the tickets
+    and the scheduling decisions, the backend runs the dispatched tickets and signals their processes
+    """
+
+    def bind(self, controller) -> None:
+        """
+        called once by every MetaMPController created with this backend
+        :param controller: the MetaMPController
+        :return:
+        """
+        pass
+
+    def now(self) -> float:
+        """
+        :return: current time in seconds, all the deadlines of the controller are measured with this clock
+        """
+        return time.time()
+
+    def capacity(self, controller) -> int:
+        """
+        :param controller: the MetaMPController
+        :return: number of tickets the backend can run at once, max_num_process caps it as well
+        """
+        return controller._max_num_process
+
+    @abc.abstractmethod
+    def launch(self, controller, task_uuid: str, target_task: type, kwargs: dict) -> int:
+        """
+        start running a dispatched ticket, the backend calls controller._release_ticket once it ended
+        :param controller: the MetaMPController dispatching the ticket
+        :param task_uuid: the ticket
+        :param target_task: the task class to run
+        :param kwargs: kwargs of the ticket
+        :return: ident linking the ticket to its process in controller._control_relationship
+        """
+        pass
+
+    @abc.abstractmethod
+    def request_stop(self, controller, pid: int) -> None:
+        """
+        ask a running process to stop at its next checkpoint
+        :param controller: the MetaMPController
+        :param pid: the process to stop
+        :return:
+        """
+        pass
+
+    @abc.abstractmethod
+    def suspend(self, controller, pid: int) -> None:
+        """
+        pause a running process
+        :param controller: the MetaMPController
+        :param pid: the process to pause
+        :return:
+        """
+        pass
+
+    @abc.abstractmethod
+    def resume(self, controller, pid: int) -> None:
+        """
+        continue a paused process
+        :param controller: the MetaMPController
+        :param pid: the process to continue
+        :return:
+        """
+        pass
+
+    def on_ticket_enqueue(self, controller, task_uuid: str) -> None:
+        """
+        called by the controller when a ticket entered the waiting queue
+        :param controller: the MetaMPController
+        :param task_uuid: the queued ticket
+        :return:
+        """
+        pass
+
+    def on_ticket_end(self, controller, task_uuid: str, final_state: dict) -> None:
+        """
+        called by the controller when a ticket or a pipeline run ended, either run or dropped from the queue
+        :param controller: the MetaMPController
+        :param task_uuid: the ended ticket
+        :param final_state: final state of the ticket, as returned by GET
+        :return:
+        """
+        pass
+
+
+class MultiprocessingBackend(MetaMPBackend):
+    """
+    default backend, every ticket runs in its own process watched by its own controlling thread
+    """
+
+    def bind(self, controller) -> None:
+        controller._start_threads()
+
+    def launch(self, controller, task_uuid: str, target_task: type, kwargs: dict) -> int:
+        post_thread = threading.Thread(target=controller._running, args=(task_uuid, target_task,),
+                                       kwargs=kwargs, daemon=True, name='POST_THREAD')
+        post_thread.start()
+        return post_thread.ident
+
+    def request_stop(self, controller, pid: int) -> None:
+        # the primitives are gone once the process exited
+        primitives = controller._process_primitives.get(pid)
+        if primitives is not None:
+            primitives[controller._EVENT_POS].set()
+
+    # the sub-workers of the task are paused and continued along with it
+    def suspend(self, controller, pid: int) -> None:
+        signal_process_group(pid, signal.SIGSTOP)
+
+    def resume(self, controller, pid: int) -> None:
+        signal_process_group(pid, signal.SIGCONT)
+
+
+class _SimulatedProcess(object):
+    """
+    virtual process of the simulated backend
+    """
+
+    def __init__(self, controller, task_uuid: str, target_task: type, kwargs: dict, work: float):
+        self.controller = controller
+        self.task_uuid: str = task_uuid
+        self.target_task: type = target_task
+        self.kwargs: dict = kwargs
+        # virtual seconds of work left, counted from running_since
+        self.work: float = work
+        self.running_since: Optional[float] = None
+        # bumped whenever the scheduled end becomes stale
+        self.token: int = 0
+        self.failed: bool = False
+        # set when a stop request ends the ticket before its work is done
+        self.stopped: bool = False
+
+
+class SimulatedBackend(MetaMPBackend):
+    """
+    deterministic backend running the tickets as stubs in virtual time, in the calling thread
+
+    - no thread, process or signal is involved, the controllers' queue listener, deadline watcher and memory
+      watchdog are not started, run() dispatches the tickets of every controller bound to this backend
+    - the duration of a ticket is drawn from `duration(rng, kwargs)`, see constant, uniform, exponential and
+      lognormal, by default the `duration` kwarg of the ticket
+    - a stop request ends the ticket after stop_latency seconds, a suspended ticket does not progress, a ticket
+      requeued by preemption runs its whole duration again
+    - a ticket fails with probability failure_rate
+    - `run_at` and `delay` of the tickets are in virtual seconds
+    """
+
+    def __init__(self, duration: Callable[[random.Random, dict], float] = None, seed: int = 0,
+                 stop_latency: float = 0., failure_rate: float = 0.):
+        self._duration: Callable[[random.Random, dict], float] = duration or self.from_kwargs()
+        self._random = random.Random(seed)
+        self._stop_latency: float = stop_latency
+        self._failure_rate: float = failure_rate
+        self._now: float = 0.
+        # (time, sequence, action, args), the sequence keeps the order of simultaneous events deterministic
+        self._events: List[tuple] = list()
+        self._sequence = itertools.count()
+        self._pids = itertools.count(1)
+        self._controllers: List = list()
+        self._processes: Dict[int, _SimulatedProcess] = dict()
+        # ticket -> time it was first dispatched
+        self._start_time: Dict[str, float] = dict()
+        self._records: List[dict] = list()
+        # time the last ticket ended, the throughput is measured up to it
+        self._last_end_time: float = 0.
+
+    @staticmethod
+    def from_kwargs(key: str = 'duration', default: float = 1.) -> Callable[[random.Random, dict], float]:
+        return lambda rng, kwargs: float(kwargs.get(key, default))
+
+    @staticmethod
+    def constant(value: float) -> Callable[[random.Random, dict], float]:
+        return lambda rng, kwargs: value
+
+    @staticmethod
+    def uniform(low: float, high: float) -> Callable[[random.Random, dict], float]:
+        return lambda rng, kwargs: rng.uniform(low, high)
+
+    @staticmethod
+    def exponential(mean: float) -> Callable[[random.Random, dict], float]:
+        return lambda rng, kwargs: rng.expovariate(1. / mean)
+
+    @staticmethod
+    def lognormal(mu: float, sigma: float) -> Callable[[random.Random, dict], float]:
+        return lambda rng, kwargs: rng.lognormvariate(mu, sigma)
+
+    def bind(self, controller) -> None:
+        self._controllers.append(controller)
+
+    def now(self) -> float:
+        return self._now
+
+    def _schedule(self, at: float, action: Callable, *args) -> None:
+        heapq.heappush(self._events, (at, next(self._sequence), action, args))
+
+    def submit(self, controller, at: float = None, **kwargs) -> None:
+        """
+        POST a ticket to a controller at a virtual time
+        :param controller: a MetaMPController bound to this backend
+        :param at: virtual time of the request, now if not specified
+        :param kwargs: kwargs of the POST request
+        :return:
+        """
+        self._schedule(self._now if at is None else max(at, self._now), self._post, controller, kwargs)
+
+    def _post(self, controller, kwargs: dict) -> None:
+        result = controller.post(**kwargs)
+        due = controller._delay_queue.due(result.get('uuid'))
+        if due is not None:
+            # wake up when the ticket is due, _dispatch releases it
+            self._schedule(due, self._wake)
+
+    def _wake(self) -> None:
+        pass
+
+    def on_ticket_enqueue(self, controller, task_uuid: str) -> None:
+        # wake up when the ticket would expire in the queue
+        queue_deadline = controller._queue_deadline(task_uuid)
+        if queue_deadline is not None:
+            self._schedule(queue_deadline, self._expire, controller, task_uuid)
+
+    def _expire(self, controller, task_uuid: str) -> None:
+        controller._expire_queued_ticket(task_uuid, self._now)
+
+    def launch(self, controller, task_uuid: str, target_task: type, kwargs: dict) -> int:
+        pid = next(self._pids)
+        process = _SimulatedProcess(controller, task_uuid, target_task, kwargs,
+                                    max(0., float(self._duration(self._random, kwargs))))
+        process.failed = self._failure_rate > 0 and self._random.random() < self._failure_rate
+        self._processes.update({pid: process})
+        self._start_time.setdefault(task_uuid, self._now)
+        controller._process_record.update({pid: None})
+        controller._control_relationship.update({pid: pid})
+        self._run(pid)
+        run_deadline = controller._start_run_deadline(pid, kwargs)
+        if run_deadline is not None:
+            self._schedule(run_deadline, self._timeout, pid, process)
+        return pid
+
+    def _run(self, pid: int) -> None:
+        process = self._processes[pid]
+        process.running_since = self._now
+        process.token += 1
+        self._schedule(self._now + process.work, self._end, pid, process.token)
+
+    def _timeout(self, pid: int, process: _SimulatedProcess) -> None:
+        # the pid is not reused, but the process may have ended already, or its deadline moved while suspended
+        if self._processes.get(pid) is process and process.controller._run_deadline_passed(pid):
+            process.controller._request_stop(pid, 'timeout')
+
+    def request_stop(self, controller, pid: int) -> None:
+        process = self._processes[pid]
+        if process.running_since is not None:
+            process.work -= self._now - process.running_since
+        # a ticket finishing within the stop latency ends on its own
+        process.stopped = process.work > self._stop_latency
+        process.work = min(process.work, self._stop_latency)
+        if process.running_since is not None:
+            self._run(pid)
+
+    def suspend(self, controller, pid: int) -> None:
+        process = self._processes[pid]
+        process.work -= self._now - process.running_since
+        process.running_since = None
+        process.token += 1
+
+    def resume(self, controller, pid: int) -> None:
+        if pid in self._processes and self._processes[pid].running_since is None:
+            self._run(pid)
+            # the run time deadline has been pushed back by the time spent suspended
+            run_deadline = controller._run_deadlines.get(pid)
+            if run_deadline is not None:
+                self._schedule(run_deadline, self._timeout, pid, self._processes[pid])
+
+    def _end(self, pid: int, token: int) -> None:
+        process = self._processes.get(pid)
+        if process is None or process.token != token:
+            return
+        self._processes.pop(pid)
+        controller = process.controller
+        controller._process_record.pop(pid, None)
+        controller._process_progress.pop(pid, None)
+        controller._control_relationship.pop(pid, None)
+        controller._clear_run_deadline(pid)
+        if process.stopped:
+            exit_code = ABORT_EXIT_CODE
+        else:
+            exit_code = 1 if process.failed else 0
+        final_state = controller._final_state(exit_code, controller._stop_requests.pop(pid, None))
+        final_state.update({'peakRssMb': None})
+        controller._release_ticket(process.task_uuid, process.target_task, process.kwargs, final_state)
+
+    def on_ticket_end(self, controller, task_uuid: str, final_state: dict) -> None:
+        # pipeline runs are accounted by their stages
+        if 'stages' in final_state:
+            return
+        start_time = self._start_time.pop(task_uuid, None)
+        self._last_end_time = self._now
+        self._records.append({'controller': controller, 'state': final_state['state'],
+                              'queueWait': final_state.get('queueWait'),
+                              'runTime': None if start_time is None else self._now - start_time})
+
+    def _dispatch(self) -> None:
+        for controller in self._controllers:
+            controller._release_scheduled(self._now)
+            controller._dispatch_waiting()
+
+    def run(self, until: float = None) -> dict:
+        """
+        process the events in virtual time order, dispatching the waiting tickets after each of them
+        :param until: stop at this virtual time, run until nothing is left to do if not specified
+        :return: the report, see report
+        """
+        self._dispatch()
+        while self._events:
+            if until is not None and self._events[0][0] > until:
+                break
+            at, _, action, args = heapq.heappop(self._events)
+            self._now = max(self._now, at)
+            action(*args)
+            self._dispatch()
+        if until is not None:
+            self._now = max(self._now, until)
+        return self.report()
+
+    @staticmethod
+    def _percentiles(values: List[float]) -> dict:
+        if not values:
+            return {'mean': None, 'p50': None, 'p90': None, 'p99': None, 'max': None}
+        values = sorted(values)
+
+        def _percentile(q):
+            return values[min(len(values) - 1, int(math.ceil(q * len(values))) - 1)]
+        return {'mean': sum(values) / len(values), 'p50': _percentile(.5), 'p90': _percentile(.9),
+                'p99': _percentile(.99), 'max': values[-1]}
+
+    def report(self) -> dict:
+        """
+        :return: virtual time elapsed, tickets ended per state, throughput of the finished tickets per virtual
+        second until the last ticket ended, queue wait and run time percentiles of the dispatched tickets, the same
+        per controller, and Jain's fairness index of the finished tickets per controller weighted by their share of
+        the process budget
+        """
+        states = dict()
+        for record in self._records:
+            states[record['state']] = states.get(record['state'], 0) + 1
+        finished = states.get('finished', 0)
+        controllers = dict()
+        weighted = list()
+        for controller in self._controllers:
+            records = [record for record in self._records if record['controller'] is controller]
+            controller_finished = sum(1 for record in records if record['state'] == 'finished')
+            name = controller._name
+            if name in controllers:
+                name = '{}#{}'.format(name, len(controllers) + 1)
+            controllers.update({name: {
+                'ended': len(records), 'finished': controller_finished,
+                'throughput': controller_finished / self._last_end_time if self._last_end_time > 0 else None,
+                'queueWait': self._percentiles([record['queueWait'] for record in records
+                                                if record['runTime'] is not None])}})
+            weight = controller._budget._weights[id(controller)] if controller._budget is not None else 1.
+            weighted.append(controller_finished / weight)
+        square_sum = sum(value * value for value in weighted)
+        return {'time': self._now,
+                'ended': len(self._records),
+                'states': states,
+                'throughput': finished / self._last_end_time if self._last_end_time > 0 else None,
+                'queueWait': self._percentiles([record['queueWait'] for record in self._records
+                                                if record['runTime'] is not None]),
+                'runTime': self._percentiles([record['runTime'] for record in self._records
+                                              if record['runTime'] is not None]),
+                'controllers': controllers,
+                'fairness': sum(weighted) ** 2 / (len(weighted) * square_sum) if square_sum > 0 else None}
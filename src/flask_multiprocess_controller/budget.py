@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_multiprocess_controller.budget
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module implements a process budget shared by several MPControllers of the same application, so that all
+    together they never run more processes than the host can take.
+
+    :copyright: 2022 Yuhao Wang
+    :license: BSD-3-Clause
+"""
+
+import threading
+from typing import Dict, List
+
+
+class ProcessBudget(object):
+    """
+    process slots shared by the controllers registered to it
+
+    - every controller has a weighted share of the slots and may borrow the slots the others leave idle, unless a
+      controller under its share has tickets waiting and room to dispatch them
+    - the slots of a controller's minimum are always kept for it
+    - max_num_process of each controller still caps it on its own
+    """
+
+    def __init__(self, total: int):
+        assert total > 0, "total should be greater than 0, passing {}".format(total)
+        self.total: int = total
+        self._lock = threading.Lock()
+        self._controllers: List = list()
+        self._names: Dict[int, str] = dict()
+        self._weights: Dict[int, float] = dict()
+        self._minimums: Dict[int, int] = dict()
+        self._used: Dict[int, int] = dict()
+
+    def register(self, controller, weight: float = 1., minimum: int = 0) -> None:
+        """
+        called by MetaMPController when created with this budget
+        :param controller: the MetaMPController
+        :param weight: weight of the controller's share
+        :param minimum: number of slots always kept for the controller
+        :return:
+        """
+        assert weight > 0, "weight should be greater than 0, passing {}".format(weight)
+        with self._lock:
+            assert sum(self._minimums.values()) + minimum <= self.total, \
+                "the minimums of the controllers exceed the budget of {} processes".format(self.total)
+            key = id(controller)
+            name = controller._name
+            if name in self._names.values():
+                name = '{}#{}'.format(name, len(self._controllers) + 1)
+            self._controllers.append(controller)
+            self._names.update({key: name})
+            self._weights.update({key: weight})
+            self._minimums.update({key: minimum})
+            self._used.update({key: 0})
+
+    def _share(self, key: int) -> float:
+        return self.total * self._weights[key] / sum(self._weights.values())
+
+    def try_acquire(self, controller) -> bool:
+        """
+        take a slot for the controller if the budget allows it
+        :param controller: a registered MetaMPController
+        :return: True if the slot has been taken
+        """
+        key = id(controller)
+        with self._lock:
+            free = self.total - sum(self._used.values())
+            reserved = sum(max(0, self._minimums[other] - self._used[other]) for other in self._used if other != key)
+            if free - reserved < 1:
+                return False
+            if self._used[key] >= max(self._share(key), self._minimums[key]):
+                # borrowing, only if no other controller under its share is waiting for a slot, a controller capped
+                # below its share by max_num_process (or its backend) cannot take more than its cap
+                for other_controller in self._controllers:
+                    other = id(other_controller)
+                    if other != key and self._used[other] < min(self._share(other), other_controller._slot_limit()) \
+                            and other_controller._has_waiting_tickets():
+                        return False
+            self._used[key] += 1
+            return True
+
+    def acquire(self, controller) -> None:
+        """
+        take a slot for the controller regardless of the budget, e.g. to let a suspended process exit
+        :param controller: a registered MetaMPController
+        :return:
+        """
+        with self._lock:
+            self._used[id(controller)] += 1
+
+    def release(self, controller) -> None:
+        """
+        give a slot back and wake up the other controllers, the ones furthest below their share first
+        :param controller: a registered MetaMPController
+        :return:
+        """
+        with self._lock:
+            self._used[id(controller)] -= 1
+            waiting = sorted((other for other in self._controllers if other is not controller),
+                             key=lambda other: self._used[id(other)] / self._share(id(other)))
+        for other_controller in waiting:
+            other_controller._waiting_queue_intake_event.set()
+
+    def allocations(self) -> dict:
+        """
+        :return: controller name -> slots used, weighted share and minimum
+        """
+        with self._lock:
+            return {self._names[key]: {'used': self._used[key], 'share': round(self._share(key), 2),
+                                       'minimum': self._minimums[key]}
+                    for key in self._used}
@@ -11,19 +11,35 @@
 
 import abc
 import functools
+import heapq
+import itertools
 import logging
 import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
 import threading
+import time
 import uuid
 
 from multiprocessing import Process, Event, Lock, Queue
+from collections import OrderedDict
 from multiprocessing.connection import Connection
-from queue import PriorityQueue
-from typing import Dict, Tuple
+from queue import PriorityQueue, Full
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 from werkzeug.exceptions import MethodNotAllowed
 
 from .logger import MetaMPLoggerConfigurator, DefaultMPLoggerConfigurator
-from .utils import send_request
+from .backend import MetaMPBackend, MultiprocessingBackend
+from .budget import ProcessBudget
+from .dataset import DatasetHandle, DatasetRegistry
+from .payload import DEFAULT_SPOOL_DIR, release_payloads
+from .pipeline import Pipeline, PipelineRun
+from .schedule import DelayQueue, parse_run_at
+from .snapshot import SnapshotStore
+from .utils import ABORT_EXIT_CODE, send_request, get_process_groups, get_process_group_rss, shorten_repr, \
+    signal_process_group
 
 from .task import MetaMPTask
 
@@ -40,10 +56,31 @@ class MetaMPController(metaclass=abc.ABCMeta):
     # static bool to protect logger from been initialed twice when multiple controller exists
     _logger_init_counter: bool = False
     _name: str = 'Basic'
+    # environment variables read by OpenMP/BLAS runtimes to size their thread pools
+    _THREAD_ENV_VARS = MetaMPTask._THREAD_ENV_VARS
+    # os.environ is process-wide, guard it while a worker is being started with its own thread settings
+    _spawn_env_lock = threading.Lock()
+    # how often the controlling thread checks deadlines and pending stop requests of its process, in seconds
+    _SUPERVISE_INTERVAL: float = 0.5
+    # how many ended tickets are kept for GET to report their final state
+    _HISTORY_SIZE: int = 1000
+    _MB: int = 1024 * 1024
+    # longest repr of the arguments and return value logged for each http request
+    _LOG_MAX_LENGTH: int = 512
+    # how often the stale snapshots are garbage collected, in seconds
+    _SNAPSHOT_GC_INTERVAL: float = 600.
 
     def __init__(self, target_task: type(MetaMPTask), callback_url: str = None,
                  max_num_process: int = 1, max_num_queue: int = -1,
-                 logger_configurator_cls: type(MetaMPLoggerConfigurator) = DefaultMPLoggerConfigurator):
+                 logger_configurator_cls: type(MetaMPLoggerConfigurator) = DefaultMPLoggerConfigurator,
+                 cpu_affinity: bool = False, cores_per_process: int = None, num_threads: int = None,
+                 task_timeout: float = None, queue_timeout: float = None, termination_grace_period: float = 10.,
+                 memory_soft_limit: float = None, memory_hard_limit: float = None,
+                 memory_check_interval: float = 1., spool_dir: str = None,
+                 state_dir: str = None, state_ttl: float = 7 * 24 * 3600.,
+                 preemption_priority: int = None, preemption_policy: str = 'suspend',
+                 budget: ProcessBudget = None, budget_weight: float = 1., budget_minimum: int = 0,
+                 backend: MetaMPBackend = None):
         assert max_num_process > 0, "max_num_process should be greater than 0, passing {}".format(max_num_process)
         self._max_num_process = max_num_process
         # because of GIL, the following dicts are thread-safe
@@ -51,13 +88,16 @@ class MetaMPController(metaclass=abc.ABCMeta):
         self._process_record: Dict[int, Process] = dict()
         self._process_progress: Dict[int, int] = dict()
         self._process_primitives: Dict[int, Tuple[Event, Connection, Lock]] = dict()
+        # cpu set and thread count each worker has been placed with, exposed by GET
+        self._process_placement: Dict[int, Tuple[Optional[Tuple[int, ...]], Optional[int]]] = dict()
+        # pid -> [time the stop was requested, reason, escalation level], see _escalate_stop
+        self._stop_requests: Dict[int, list] = dict()
+        # resident set size of the workers in bytes, sampled by the memory watchdog
+        self._process_rss: Dict[int, int] = dict()
+        self._process_peak_rss: Dict[int, int] = dict()
         self._log_queue: Queue = Queue(-1)
         self._log_configurator = logger_configurator_cls
 
-        # start the listening process right after creating the controller
-        self._logging_thread = threading.Thread(target=self._listening_log, daemon=True, name='LogListener')
-        self._logging_thread.start()
-
         # log the relation between controlling thread and the process being controlled
         # future cancel request or query request will need the ident of the controlling thread to link to the process
         self._control_relationship: Dict[int, int] = dict()
@@ -72,18 +112,129 @@ class MetaMPController(metaclass=abc.ABCMeta):
         # init set the linking task to None
         self._linking_task = target_task
 
+        # worker placement: split the cpus this process may run on into one core set per slot, a core set is
+        # handed to a worker when it starts and returned to the pool when it exits
+        self._num_threads: Optional[int] = num_threads
+        self._core_sets: List[Tuple[int, ...]] = list()
+        self._core_set_usage: Dict[Tuple[int, ...], int] = dict()
+        self._core_set_lock = threading.Lock()
+        if cpu_affinity:
+            self._core_sets = self._build_core_sets(max_num_process, cores_per_process)
+            self._core_set_usage = {core_set: 0 for core_set in self._core_sets}
+
+        # read-only datasets shared by all the tasks, see register_dataset
+        self._spool_dir: str = spool_dir or DEFAULT_SPOOL_DIR
+        self._datasets = DatasetRegistry(self._spool_dir)
+
+        # pipelines: DAGs of tasks submitted at once, see add_pipeline
+        # each stage gets its own ticket, linked to the job uuid identifying the whole run
+        self._pipelines: Dict[str, Pipeline] = dict()
+        self._jobs: Dict[str, PipelineRun] = dict()
+        self._ticket_job: Dict[str, str] = dict()
+        self._job_lock = threading.RLock()
+        # task class of the tickets not running the linking task
+        self._ticket_task: Dict[str, type(MetaMPTask)] = dict()
+
+        # snapshots of the tasks' state, to resume a ticket that did not finish by POST with `resume=<uuid>`,
+        # disabled if state_dir is not specified, snapshots not touched for state_ttl seconds are removed
+        self._snapshots: Optional[SnapshotStore] = None
+        if state_dir is not None:
+            self._snapshots = SnapshotStore(state_dir, state_ttl)
+            self._snapshots.collect()
+
+        # delay stage: tickets submitted with `run_at` or `delay` wait here until they are due to enter the queue,
+        # they are recorded in the state_dir if any, and scheduled again after a restart
+        self._delay_queue = DelayQueue()
+        # scheduled ticket -> (task class, None for the linking task, kwargs)
+        self._scheduled_tickets: Dict[str, Tuple[Optional[type(MetaMPTask)], dict]] = dict()
+        if self._snapshots is not None:
+            for task_uuid, target_task, kwargs, due in self._snapshots.load_schedules():
+                self._scheduled_tickets.update({task_uuid: (target_task, kwargs)})
+                self._delay_queue.push(task_uuid, due)
+
         # init the waiting queue and ticket system to handle waiting requests
         # using priority queue to support the shortcut functionality
         self._waiting_queue = PriorityQueue(maxsize=max_num_queue)
+        # tickets of the same priority leave the queue in the order they entered it
+        self._enqueue_sequence = itertools.count()
         self._ticket_log: Dict[str, dict] = dict()
         self._ticket_control_relationship: Dict[str, int] = dict()
+        # queued tickets that have been cancelled before dispatching, the queue listener will skip them
+        self._cancelled_tickets: Dict[str, str] = dict()
+        # final state of the ended tickets, oldest first
+        self._ticket_history: OrderedDict = OrderedDict()
 
-        # using another thread to listen to the queue and create the control thread for each task
+        # deadlines in seconds, None for no limit, can be overridden per request by `timeout` and `queue_timeout`
+        # once a deadline expires, the process is stopped by the stop flag, then SIGTERM and SIGKILL with
+        # termination_grace_period in between
+        self._task_timeout: Optional[float] = task_timeout
+        self._queue_timeout: Optional[float] = queue_timeout
+        self._termination_grace_period: float = termination_grace_period
+        self._ticket_enqueue_time: Dict[str, float] = dict()
+        # pid -> run time deadline of the running processes, the time left is kept aside while a process is suspended
+        self._run_deadlines: Dict[int, float] = dict()
+        self._paused_run_time: Dict[int, float] = dict()
+        # seconds the dispatched tickets have spent in the queue, reported in their final state
+        self._ticket_queue_wait: Dict[str, float] = dict()
+
+        # preemption: a ticket with priority <= preemption_priority (lower is more urgent) that finds no free slot
+        # takes the slot of the least urgent, least advanced running task with a lower priority, which is either
+        # suspended with SIGSTOP until a slot frees up (`suspend`), or stopped through the stop flag and put back
+        # in the queue (`requeue`, resuming from its snapshot if the controller has a state_dir)
+        assert preemption_policy in ('suspend', 'requeue'), \
+            "preemption_policy should be 'suspend' or 'requeue', passing {}".format(preemption_policy)
+        self._preemption_priority: Optional[int] = preemption_priority
+        self._preemption_policy: str = preemption_policy
+        self._preemption_counter = 0
+        self._ticket_preemptions: Dict[str, int] = dict()
+        # suspended ticket -> pid, they do not count as running
+        self._suspended: Dict[str, int] = dict()
+        # core sets given back by the suspended processes, pid -> core set
+        self._lent_core_sets: Dict[int, Tuple[int, ...]] = dict()
+        # tickets being stopped to be requeued
+        self._preempting: Set[str] = set()
+
+        # process budget shared with other controllers, every dispatched ticket takes a slot from it
+        self._budget: Optional[ProcessBudget] = budget
+        if budget is not None:
+            budget.register(self, budget_weight, budget_minimum)
+
+        # set to wake the queue listener thread up
         self._waiting_queue_intake_event = Event()
+
+        # memory limits of a single worker in MB, None for no limit
+        # above the soft limit the worker is warned and stopped through the stop flag (escalating like a deadline)
+        # above the hard limit the worker is killed right away
+        self._memory_soft_limit: Optional[float] = memory_soft_limit
+        self._memory_hard_limit: Optional[float] = memory_hard_limit
+        self._memory_check_interval: float = memory_check_interval
+
+        # the backend runs the dispatched tickets, in processes by default, see SimulatedBackend to simulate them
+        # the multiprocessing backend starts the listening threads of the controller right away
+        self._backend: MetaMPBackend = backend if backend is not None else MultiprocessingBackend()
+        self._backend.bind(self)
+
+    def _start_threads(self) -> None:
+        """
+        start the threads listening to the logs and the queue, and watching the deadlines and the memory
+        :return:
+        """
+        self._logging_thread = threading.Thread(target=self._listening_log, daemon=True, name='LogListener')
+        self._logging_thread.start()
+
+        # using another thread to listen to the queue and create the control thread for each task
         self._waiting_queue_listener_thread = threading.Thread(target=self._listening_queue,
                                                                daemon=True, name='QueueListener')
         self._waiting_queue_listener_thread.start()
 
+        # expire the tickets waiting in the queue for too long
+        self._deadline_thread = threading.Thread(target=self._watching_deadline, daemon=True, name='DeadlineWatcher')
+        self._deadline_thread.start()
+
+        self._memory_watchdog_thread = threading.Thread(target=self._watching_memory, daemon=True,
+                                                        name='MemoryWatchdog')
+        self._memory_watchdog_thread.start()
+
     # noinspection PyMethodOverriding
     def __init_subclass__(cls, controller_name: str = None, logger: logging.Logger = None, decorator=None) -> None:
 
@@ -97,7 +248,7 @@ class MetaMPController(metaclass=abc.ABCMeta):
 
         # default decorator set to simple print info if not specified
         if decorator is None:
-            __decorator = cls._print_request_info(cls._logger, cls._name)
+            __decorator = cls._print_request_info(cls._logger, cls._name, cls._LOG_MAX_LENGTH)
         else:
             __decorator = decorator
 
@@ -111,10 +262,13 @@ class MetaMPController(metaclass=abc.ABCMeta):
         cls.patch = __decorator(cls.patch)
 
     @staticmethod
-    def _print_request_info(current_logger: logging.Logger, cls_name: str):
+    def _print_request_info(current_logger: logging.Logger, cls_name: str, max_length: int = None):
         """
         decorator for logging passing params and return value of a http request
+
+        nothing is formatted when INFO is disabled on the logger
         :param current_logger: logger assigned to the http method or the service controller
+        :param max_length: params and return value are truncated to this many characters, None for no limit
         :return:
         """
         # use the basic logger to logger if child logger has not been defined
@@ -125,8 +279,10 @@ class MetaMPController(metaclass=abc.ABCMeta):
             @functools.wraps(func)
             def _decorated_func(*args, **kwargs):
                 result = func(*args, **kwargs)
-                current_logger.info('class {}\'s {} been called with arguments {}, return {}'.format(
-                                    cls_name, func.__name__, kwargs, result))
+                if current_logger.isEnabledFor(logging.INFO):
+                    current_logger.info('class %s\'s %s been called with arguments %s, return %s',
+                                        cls_name, func.__name__, shorten_repr(kwargs, max_length),
+                                        shorten_repr(result, max_length))
                 return result
             return _decorated_func
         return _func_define_decorator
@@ -145,27 +301,12 @@ class MetaMPController(metaclass=abc.ABCMeta):
         :return:
         """
         task_uuid = kwargs.get('uuid', None)
+        if kwargs.get('metrics', False):
+            return self.metrics()
         if task_uuid is not None:
-            if task_uuid in self._ticket_control_relationship:
-                # acquire the process object
-                target_process = self._control_relationship[self._ticket_control_relationship[task_uuid]]
-                # acquire Lock before reading Pipe in case the worker processes may be using it
-                self._process_primitives[target_process][self._LOCK_POS].acquire()
-                try:
-                    progress_list = list()
-                    # read all the content from the pipe
-                    while self._process_primitives[target_process][self._PIPE_POS].poll():
-                        progress_list.append(self._process_primitives[target_process][self._PIPE_POS].recv())
-                    # update the progress dict if receive the newest progress
-                    if len(progress_list) > 0:
-                        self._process_progress.update({target_process: max(progress_list)})
-                # release Lock after reading Pipe
-                finally:
-                    self._process_primitives[target_process][self._LOCK_POS].release()
-                return {'msg': "Process is running with uuid {}.".format(task_uuid),
-                        'progressNum': "{}".format(self._process_progress.get(target_process, 0))}
-            else:
-                return {'msg': "No process linked to this uuid {}.".format(task_uuid)}
+            if task_uuid in self._jobs:
+                return self._job_status(task_uuid)
+            return self._ticket_status(task_uuid)
         else:
             return {'msg': "Invalid request: {}".format(kwargs)}
 
@@ -178,22 +319,88 @@ class MetaMPController(metaclass=abc.ABCMeta):
         :return:
         """
         self._call_counter += 1
-        task_uuid = str(uuid.uuid4())
-        # use the ticket log to log the input params
-        self._ticket_log.update({task_uuid: kwargs})
-        # put the request in to the waiting queue with init priority 0 if not specified
-        self._waiting_queue.put_nowait((kwargs.get("priority", 0), task_uuid))
+        # a rejected request queues nothing, the body it may have spooled is removed right away
+        try:
+            response = self._submit(kwargs)
+        except BaseException:
+            release_payloads(kwargs)
+            raise
+        if 'uuid' not in response:
+            release_payloads(kwargs)
+        return response
 
-        # upon receiving new request, check the current num of processes, if able to proceed, trigger the signal
-        # to queue listener thread to execute
-        if len(self._process_record) < self._max_num_process:
-            self._waiting_queue_intake_event.set()
+    def _submit(self, kwargs: dict) -> dict:
+        """
+        called by post to queue, schedule or resume the ticket (or the pipeline run) requested
+        :param kwargs: kwargs of the POST request
+        :return: the result returned by POST, without `uuid` if the request has been rejected
+        """
+        deadline_error = self._parse_deadlines(kwargs)
+        if deadline_error is not None:
+            return {'msg': deadline_error}
+        if kwargs.get('pipeline') is not None:
+            return self._submit_pipeline(kwargs)
+        if kwargs.get('shards') is not None or kwargs.get('shard_items') is not None:
+            return self._submit_sharded(kwargs)
+        if kwargs.get('resume') is not None:
+            return self._resume_ticket(kwargs)
+        task_uuid = str(uuid.uuid4())
+        if kwargs.get('run_at') is not None or kwargs.get('delay') is not None:
+            return self._schedule_ticket(task_uuid, kwargs)
+        self._enqueue_ticket(task_uuid, kwargs)
 
         return {'msg': "Internal UUID {} for {} task put in the queue.".format(task_uuid, self._name),
                 'uuid': "{}".format(task_uuid),
                 'requestParams': "{}".format(kwargs),
                 'taskCounter': str(self._call_counter)}
 
+    def metrics(self) -> dict:
+        """
+        controller level metrics, returned by GET when requested with `metrics`
+        :return:
+        """
+        ended_states = dict()
+        for final_state in list(self._ticket_history.values()):
+            ended_states[final_state['state']] = ended_states.get(final_state['state'], 0) + 1
+        ended_peak_rss = [final_state['peakRssMb'] for final_state in list(self._ticket_history.values())
+                          if final_state.get('peakRssMb') is not None]
+        return {'name': self._name,
+                'taskCounter': self._call_counter,
+                'runningNum': len(self._process_record) - len(self._suspended),
+                'suspendedNum': len(self._suspended),
+                'preemptionCounter': self._preemption_counter,
+                'queuingNum': self._waiting_queue.qsize(),
+                'scheduledNum': len(self._delay_queue),
+                'endedStates': ended_states,
+                'rssMb': {pid: self._to_mb(rss) for pid, rss in list(self._process_rss.items())},
+                'peakRssMb': max(ended_peak_rss + [self._to_mb(rss) for rss in
+                                                   list(self._process_peak_rss.values())], default=None),
+                'datasets': self._datasets.describe(),
+                'budget': self._budget.allocations() if self._budget is not None else None}
+
+    def register_dataset(self, name: str, data: Any = None, path: str = None,
+                         loader: Callable[[], Any] = None) -> DatasetHandle:
+        """
+        share a read-only dataset with every task of this controller, tasks access it by MetaMPTask.get_dataset
+
+        registering an existing name publishes a new version to the tasks started afterwards, the running tasks
+        keep the version they started with
+        :param name: name of the dataset
+        :param data: NumPy array or bytes-like object, written once to the spool directory
+        :param path: existing file to map as is (.npy files are mapped as NumPy arrays)
+        :param loader: callable returning data, called once
+        :return: handle of the published version
+        """
+        return self._datasets.register(name, data=data, path=path, loader=loader)
+
+    def unregister_dataset(self, name: str) -> None:
+        """
+        withdraw a dataset from the tasks started afterwards
+        :param name: name of the dataset
+        :return:
+        """
+        self._datasets.unregister(name)
+
     def head(self, *args, **kwargs) -> dict:
         """
         function to run when linking resource receives a head request
@@ -226,15 +433,9 @@ class MetaMPController(metaclass=abc.ABCMeta):
         """
         task_uuid = kwargs.get('uuid', None)
         if task_uuid is not None:
-            if task_uuid in self._ticket_control_relationship:
-                target_process = self._control_relationship[self._ticket_control_relationship[task_uuid]]
-                # set the stop event to be True, let the process to exit safely
-                self._process_primitives[target_process][self._EVENT_POS].set()
-                # no need to do anything else as the controlling thread will monitor the process
-                # and handle it itself
-                return {'msg': "Stop signal sent to this uuid {}.".format(task_uuid)}
-            else:
-                return {'msg': "No process linked to this uuid {}.".format(task_uuid)}
+            if task_uuid in self._jobs:
+                return self._stop_job(task_uuid)
+            return self._stop_ticket(task_uuid)
         else:
             return {'msg': "Invalid request: {}".format(kwargs)}
 
@@ -271,6 +472,674 @@ class MetaMPController(metaclass=abc.ABCMeta):
         """
         raise MethodNotAllowed()
 
+    def _build_core_sets(self, num_sets: int, cores_per_set: int = None) -> List[Tuple[int, ...]]:
+        """
+        split the cpus available to the current process into core sets, one for each worker slot
+        :param num_sets: number of core sets to build, normally max_num_process
+        :param cores_per_set: number of cores in each core set, by default share the available cpus evenly
+        :return: list of core sets, empty if cpu affinity is not supported on this platform
+        """
+        if not hasattr(os, 'sched_setaffinity'):
+            self._logger.warning("cpu affinity is not supported on this platform, workers will not be pinned.")
+            return list()
+        available_cpus = sorted(os.sched_getaffinity(0))
+        if cores_per_set is None:
+            cores_per_set = max(1, len(available_cpus) // num_sets)
+        assert cores_per_set > 0, "cores_per_process should be greater than 0, passing {}".format(cores_per_set)
+        if cores_per_set * num_sets > len(available_cpus):
+            self._logger.warning("{} slots with {} cores each oversubscribe the {} available cpus, "
+                                 "core sets will overlap.".format(num_sets, cores_per_set, len(available_cpus)))
+        core_sets = list()
+        for set_idx in range(num_sets):
+            core_set = tuple(sorted({available_cpus[(set_idx * cores_per_set + core_idx) % len(available_cpus)]
+                                     for core_idx in range(cores_per_set)}))
+            core_sets.append(core_set)
+        return core_sets
+
+    def _acquire_core_set(self) -> Optional[Tuple[int, ...]]:
+        """
+        take the least used core set for a new worker
+        :return: the core set to pin the worker on, None if cpu affinity is disabled
+        """
+        if not self._core_sets:
+            return None
+        with self._core_set_lock:
+            # a free core set has usage 0, min also tolerates more workers than slots
+            core_set = min(self._core_sets, key=lambda cores: self._core_set_usage[cores])
+            self._core_set_usage[core_set] += 1
+        return core_set
+
+    def _release_core_set(self, core_set: Optional[Tuple[int, ...]]) -> None:
+        """
+        give the core set back to the pool after its worker exited
+        :param core_set: the core set returned by _acquire_core_set
+        :return:
+        """
+        if core_set is None:
+            return
+        with self._core_set_lock:
+            self._core_set_usage[core_set] -= 1
+
+    def _core_budget(self, cpu_set: Optional[Tuple[int, ...]]) -> int:
+        """
+        :param cpu_set: the core set of the worker, None if cpu affinity is disabled
+        :return: number of cores a worker may use for its own sub-workers
+        """
+        if cpu_set is not None:
+            return len(cpu_set)
+        return max(1, (os.cpu_count() or 1) // self._max_num_process)
+
+    def _start_process(self, process: Process, cpu_set: Optional[Tuple[int, ...]],
+                       num_threads: Optional[int]) -> None:
+        """
+        start the worker process with its cpu set and thread count already in place, so that the settings are
+        inherited before any module of the task is imported in the child
+        :param process: the worker process to start
+        :param cpu_set: cores to pin the worker on, None to inherit the controller's cpu mask
+        :param num_threads: OpenMP/BLAS thread count of the worker, None to inherit the controller's environment
+        :return:
+        """
+        # the affinity mask of the calling (controlling) thread is inherited by the forked/spawned child
+        if cpu_set is not None:
+            os.sched_setaffinity(0, cpu_set)
+        if num_threads is None:
+            process.start()
+            return
+        with self._spawn_env_lock:
+            saved_env = {env_var: os.environ.get(env_var) for env_var in self._THREAD_ENV_VARS}
+            os.environ.update({env_var: str(num_threads) for env_var in self._THREAD_ENV_VARS})
+            try:
+                process.start()
+            finally:
+                for env_var, value in saved_env.items():
+                    if value is None:
+                        os.environ.pop(env_var, None)
+                    else:
+                        os.environ[env_var] = value
+
+    def add_pipeline(self, name: str, stages: Dict[str, Tuple[type(MetaMPTask), Tuple[str, ...]]]) -> None:
+        """
+        define a pipeline that POST can submit with `pipeline=<name>`
+
+        every stage receives the kwargs of the POST request, saves its output by MetaMPTask.save_output and reads
+        the outputs of its upstream stages by MetaMPTask.load_input, a stage is queued as soon as all its upstream
+        stages finished, the stages depending on a stage that did not finish are cancelled
+        :param name: name of the pipeline
+        :param stages: stage name -> (task class, names of the upstream stages)
+        :return:
+        """
+        self._pipelines.update({name: Pipeline(stages)})
+
+    def _ticket_process(self, task_uuid: str) -> Optional[int]:
+        """
+        :param task_uuid: a dispatched ticket
+        :return: pid of the process running the ticket, None if it is not running (yet)
+        """
+        control_thread = self._ticket_control_relationship.get(task_uuid)
+        if control_thread is None:
+            return None
+        return self._control_relationship.get(control_thread)
+
+    def _ticket_status(self, task_uuid: str) -> dict:
+        """
+        :param task_uuid: any ticket
+        :return: the status of the ticket returned by GET
+        """
+        target_process = self._ticket_process(task_uuid)
+        if target_process is not None and target_process in self._process_record:
+            self._refresh_progress(target_process)
+            cpu_set, num_threads = self._process_placement.get(target_process, (None, None))
+            return {'msg': "Process is running with uuid {}.".format(task_uuid),
+                    'state': 'suspended' if task_uuid in self._suspended else 'running',
+                    'progressNum': "{}".format(self._process_progress.get(target_process, 0)),
+                    'cpuSet': list(cpu_set) if cpu_set is not None else None,
+                    'numThreads': num_threads,
+                    'rssMb': self._to_mb(self._process_rss.get(target_process)),
+                    'peakRssMb': self._to_mb(self._process_peak_rss.get(target_process)),
+                    'preemptions': self._ticket_preemptions.get(task_uuid, 0)}
+        elif task_uuid in self._ticket_history:
+            return dict({'msg': "Task with uuid {} has ended.".format(task_uuid)},
+                        **self._ticket_history[task_uuid])
+        elif task_uuid in self._ticket_control_relationship:
+            return {'msg': "Process is starting with uuid {}.".format(task_uuid), 'state': 'starting'}
+        elif task_uuid in self._delay_queue:
+            return {'msg': "Task with uuid {} is scheduled.".format(task_uuid), 'state': 'scheduled',
+                    'runAt': self._delay_queue.due(task_uuid)}
+        elif task_uuid in self._ticket_log and task_uuid not in self._cancelled_tickets:
+            return {'msg': "Task with uuid {} is waiting in the queue.".format(task_uuid), 'state': 'queued'}
+        elif task_uuid in self._ticket_job:
+            return {'msg': "Task with uuid {} waits for its upstream stages.".format(task_uuid), 'state': 'pending'}
+        else:
+            return {'msg': "No process linked to this uuid {}.".format(task_uuid)}
+
+    def _refresh_progress(self, pid: int) -> None:
+        """
+        read the progress uploaded by a process since the last call
+        :param pid: a running process
+        :return:
+        """
+        primitives = self._process_primitives.get(pid)
+        # a suspended process may have been stopped while holding the Lock
+        if primitives is None or pid in self._suspended.values():
+            return
+        # acquire Lock before reading Pipe in case the worker processes may be using it
+        # give up after a while, the process may be suspended while holding it
+        if not primitives[self._LOCK_POS].acquire(timeout=self._SUPERVISE_INTERVAL):
+            return
+        try:
+            progress_list = list()
+            # read all the content from the pipe
+            while primitives[self._PIPE_POS].poll():
+                progress_list.append(primitives[self._PIPE_POS].recv())
+            # update the progress dict if receive the newest progress
+            if len(progress_list) > 0:
+                self._process_progress.update({pid: max(progress_list)})
+        # release Lock after reading Pipe
+        finally:
+            primitives[self._LOCK_POS].release()
+
+    def _stop_ticket(self, task_uuid: str, reason: str = 'aborted') -> dict:
+        """
+        stop a running ticket or cancel a ticket waiting in the queue
+        :param task_uuid: the ticket to stop
+        :param reason: final state recorded for a running ticket
+        :return: the result returned by DELETE
+        """
+        target_process = self._ticket_process(task_uuid)
+        if self._delay_queue.remove(task_uuid):
+            target_task, kwargs = self._scheduled_tickets.pop(task_uuid)
+            if self._snapshots is not None:
+                self._snapshots.discard_schedule(task_uuid)
+            release_payloads(kwargs)
+            self._end_ticket(task_uuid, {'state': 'cancelled'})
+            return {'msg': "Scheduled task with uuid {} cancelled.".format(task_uuid)}
+        if target_process is not None:
+            # set the stop event to be True, let the process to exit safely
+            self._request_stop(target_process, reason)
+            # no need to do anything else as the controlling thread will monitor the process
+            # and handle it itself, escalating if the process does not exit in time
+            return {'msg': "Stop signal sent to this uuid {}.".format(task_uuid)}
+        elif task_uuid in self._ticket_log and self._cancel_ticket(task_uuid, 'cancelled'):
+            return {'msg': "Task with uuid {} removed from the queue.".format(task_uuid)}
+        else:
+            return {'msg': "No process linked to this uuid {}.".format(task_uuid)}
+
+    def _enqueue_ticket(self, task_uuid: str, kwargs: dict, target_task: type(MetaMPTask) = None,
+                        admitted: bool = False) -> None:
+        """
+        put a new ticket in the waiting queue
+        :param task_uuid: uuid of the ticket
+        :param kwargs: kwargs passed to the task
+        :param target_task: task class to run, the linking task if not specified
+        :param admitted: True for a ticket the controller accepted already, e.g. a stage of a pipeline run or a
+        requeued ticket, which enters the queue even if it is full, otherwise queue.Full is raised and nothing of
+        the ticket is kept
+        :return:
+        """
+        # use the ticket log to log the input params
+        self._ticket_log.update({task_uuid: kwargs})
+        self._ticket_enqueue_time.update({task_uuid: self._backend.now()})
+        if target_task is not None:
+            self._ticket_task.update({task_uuid: target_task})
+        # put the request in to the waiting queue with init priority 0 if not specified
+        entry = (kwargs.get("priority", 0), next(self._enqueue_sequence), task_uuid)
+        if admitted:
+            # what PriorityQueue.put does, without the maxsize check
+            with self._waiting_queue.mutex:
+                heapq.heappush(self._waiting_queue.queue, entry)
+                self._waiting_queue.unfinished_tasks += 1
+                self._waiting_queue.not_empty.notify()
+        else:
+            try:
+                self._waiting_queue.put_nowait(entry)
+            except Full:
+                self._ticket_log.pop(task_uuid, None)
+                self._ticket_enqueue_time.pop(task_uuid, None)
+                self._ticket_task.pop(task_uuid, None)
+                raise
+        self._backend.on_ticket_enqueue(self, task_uuid)
+
+        # upon receiving new request, trigger the signal to queue listener thread, which dispatches it if there is
+        # a free slot or a task to preempt
+        self._waiting_queue_intake_event.set()
+
+    def _resume_ticket(self, kwargs: dict) -> dict:
+        """
+        put a ticket that did not finish back in the queue under the same uuid, its task resumes from the last
+        state it saved, see MetaMPTask.load_state
+        :param kwargs: kwargs of the POST request, `resume` is the uuid of the ticket, the other kwargs override the
+        kwargs of the ticket
+        :return: the result returned by POST
+        """
+        if self._snapshots is None:
+            return {'msg': "Snapshots are disabled for {} controller.".format(self._name)}
+        # the uuid names the snapshot files, anything else must not reach the file system
+        try:
+            task_uuid = str(uuid.UUID(str(kwargs['resume'])))
+        except ValueError:
+            return {'msg': "Invalid resume, a task uuid is expected: {}".format(shorten_repr(kwargs['resume'], 64))}
+        if task_uuid in self._ticket_log:
+            return {'msg': "Task with uuid {} is still active.".format(task_uuid)}
+        snapshot = self._snapshots.load_ticket(task_uuid)
+        if snapshot is None:
+            return {'msg': "No snapshot for uuid {}.".format(task_uuid)}
+        target_task, ticket_kwargs = snapshot
+        overridden = {key: value for key, value in ticket_kwargs.items() if key in kwargs}
+        ticket_kwargs.update({key: value for key, value in kwargs.items() if key != 'resume'})
+        self._enqueue_ticket(task_uuid, ticket_kwargs,
+                             target_task if target_task is not self._linking_task else None)
+        self._ticket_history.pop(task_uuid, None)
+        # the payloads kept for the ticket and overridden by the request are not used anymore
+        release_payloads(overridden)
+        return {'msg': "Internal UUID {} for {} task put back in the queue to resume.".format(task_uuid, self._name),
+                'uuid': "{}".format(task_uuid),
+                'requestParams': "{}".format(kwargs),
+                'taskCounter': str(self._call_counter)}
+
+    def _schedule_ticket(self, task_uuid: str, kwargs: dict, target_task: type(MetaMPTask) = None) -> dict:
+        """
+        hold a new ticket in the delay stage until it is due
+        :param task_uuid: uuid of the ticket
+        :param kwargs: kwargs of the POST request, with `run_at` (epoch seconds or ISO 8601 date time) or `delay`
+        (seconds from now)
+        :param target_task: task class to run, the linking task if not specified
+        :return: the result returned by POST
+        """
+        try:
+            if kwargs.get('run_at') is not None:
+                due = parse_run_at(kwargs['run_at'])
+            else:
+                due = self._backend.now() + float(kwargs['delay'])
+        except (TypeError, ValueError) as e:
+            return {'msg': "Invalid run_at or delay: {}".format(e)}
+        self._scheduled_tickets.update({task_uuid: (target_task, kwargs)})
+        if self._snapshots is not None:
+            self._snapshots.save_schedule(task_uuid, target_task, kwargs, due)
+        self._delay_queue.push(task_uuid, due)
+        return {'msg': "Internal UUID {} for {} task scheduled.".format(task_uuid, self._name),
+                'uuid': "{}".format(task_uuid),
+                'runAt': due,
+                'requestParams': "{}".format(kwargs),
+                'taskCounter': str(self._call_counter)}
+
+    def _release_scheduled(self, now: float) -> None:
+        """
+        move the scheduled tickets due at now to the waiting queue, as long as it has room
+        :param now: current time of the backend
+        :return:
+        """
+        while not self._waiting_queue.full():
+            task_uuid = self._delay_queue.pop(now)
+            if task_uuid is None:
+                return
+            target_task, kwargs = self._scheduled_tickets.pop(task_uuid)
+            self._enqueue_ticket(task_uuid, kwargs, target_task, admitted=True)
+            if self._snapshots is not None:
+                self._snapshots.discard_schedule(task_uuid)
+
+    def _submit_pipeline(self, kwargs: dict) -> dict:
+        """
+        create the tickets of every stage of a pipeline and queue the stages without upstream
+        :param kwargs: kwargs of the POST request, `pipeline` is the name of the pipeline
+        :return: the result returned by POST
+        """
+        pipeline_name = kwargs['pipeline']
+        if pipeline_name not in self._pipelines:
+            return {'msg': "No pipeline named {}.".format(pipeline_name)}
+        stage_kwargs = {key: value for key, value in kwargs.items() if key != 'pipeline'}
+        job = PipelineRun(self._pipelines[pipeline_name], stage_kwargs,
+                          tempfile.mkdtemp(prefix='mp-pipeline-', dir=self._spool_dir))
+        if not self._start_job(job):
+            shutil.rmtree(job.work_dir, ignore_errors=True)
+            return {'msg': "The queue of {} controller is full.".format(self._name)}
+        return {'msg': "Internal UUID {} for {} pipeline {} put in the queue.".format(
+                    job.job_uuid, self._name, pipeline_name),
+                'uuid': job.job_uuid,
+                'stages': dict(job.stage_uuids),
+                'requestParams': "{}".format(kwargs),
+                'taskCounter': str(self._call_counter)}
+
+    def _submit_sharded(self, kwargs: dict) -> dict:
+        """
+        split a job into shard tickets of the linking task, spreading over the free slots, followed by a reduce
+        ticket over their outputs, see MetaMPTask.reduce
+
+        every shard gets the kwargs of the POST request, with its own chunk of `shard_items` if specified
+        :param kwargs: kwargs of the POST request, `shards` is the number of shards, by default one per item of
+        `shard_items` up to max_num_process
+        :return: the result returned by POST
+        """
+        shard_items = kwargs.get('shard_items')
+        if shard_items is not None and not isinstance(shard_items, (list, tuple)):
+            return {'msg': "Invalid shard_items, a list is expected: {}".format(shorten_repr(shard_items, 64))}
+        try:
+            num_shards = int(kwargs['shards']) if kwargs.get('shards') is not None \
+                else min(len(shard_items), self._max_num_process)
+        except (TypeError, ValueError) as e:
+            return {'msg': "Invalid shards: {}".format(e)}
+        if num_shards < 1:
+            return {'msg': "Invalid shards: a sharded job needs at least one shard."}
+        pipeline = Pipeline.sharded(self._linking_task, num_shards)
+        stage_kwargs = dict()
+        if shard_items is not None:
+            # contiguous chunks, the first len(shard_items) % num_shards shards get one item more
+            chunk_size, num_larger = divmod(len(shard_items), num_shards)
+            start = 0
+            for shard_index, shard in enumerate(pipeline.shards):
+                end = start + chunk_size + (1 if shard_index < num_larger else 0)
+                stage_kwargs.update({shard: {'shard_items': list(shard_items[start:end])}})
+                start = end
+        job_kwargs = {key: value for key, value in kwargs.items() if key != 'shards'}
+        job = PipelineRun(pipeline, job_kwargs, tempfile.mkdtemp(prefix='mp-sharded-', dir=self._spool_dir),
+                          stage_kwargs=stage_kwargs)
+        if not self._start_job(job):
+            shutil.rmtree(job.work_dir, ignore_errors=True)
+            return {'msg': "The queue of {} controller is full.".format(self._name)}
+        return {'msg': "Internal UUID {} for {} task put in the queue in {} shards.".format(
+                    job.job_uuid, self._name, num_shards),
+                'uuid': job.job_uuid,
+                'stages': dict(job.stage_uuids),
+                'requestParams': shorten_repr(kwargs, self._LOG_MAX_LENGTH),
+                'taskCounter': str(self._call_counter)}
+
+    def _start_job(self, job: PipelineRun) -> bool:
+        """
+        register a pipeline run and queue its first stages, if the waiting queue has room for them
+
+        the run is accepted as a whole, its later stages enter the queue even if it is full by then
+        :param job: the pipeline run
+        :return: False if the queue is too full, nothing is registered then
+        """
+        with self._job_lock:
+            max_num_queue = self._waiting_queue.maxsize
+            if 0 < max_num_queue < self._waiting_queue.qsize() + len(job.ready_stages()):
+                return False
+            self._jobs.update({job.job_uuid: job})
+            self._ticket_job.update({task_uuid: job.job_uuid for task_uuid in job.stages})
+            self._submit_ready_stages(job)
+        return True
+
+    def _submit_ready_stages(self, job: PipelineRun) -> None:
+        """
+        queue the stages of a pipeline run whose upstream stages all finished
+        :param job: the pipeline run
+        :return:
+        """
+        for stage in job.ready_stages():
+            job.submitted.add(stage)
+            self._enqueue_ticket(job.stage_uuids[stage], job.kwargs_of(stage), job.pipeline.tasks[stage],
+                                 admitted=True)
+
+    def _on_stage_end(self, task_uuid: str, state: str) -> None:
+        """
+        called when a ticket of a pipeline stage ended, queue the stages it unblocked or cancel the ones depending
+        on it if it did not finish, end the pipeline run once all its stages ended
+        :param task_uuid: the ended ticket
+        :param state: final state of the ticket
+        :return:
+        """
+        with self._job_lock:
+            job = self._jobs.get(self._ticket_job.pop(task_uuid, None))
+            if job is None:
+                return
+            job.states.update({job.stages[task_uuid]: state})
+            if state == 'finished':
+                self._submit_ready_stages(job)
+            else:
+                # the stages not submitted yet can never run
+                for stage in job.pipeline.order:
+                    if stage not in job.submitted:
+                        job.submitted.add(stage)
+                        self._end_ticket(job.stage_uuids[stage], {'state': 'cancelled'})
+            # the run may have been ended already by the cancelled stages above
+            if not job.ended or self._jobs.pop(job.job_uuid, None) is None:
+                return
+        shutil.rmtree(job.work_dir, ignore_errors=True)
+        release_payloads(job.kwargs)
+        self._end_ticket(job.job_uuid, {'state': job.state, 'stages': dict(job.states)})
+
+    def _job_status(self, job_uuid: str) -> dict:
+        """
+        :param job_uuid: uuid of a running pipeline
+        :return: the status of every stage returned by GET
+        """
+        job = self._jobs[job_uuid]
+        stages = dict()
+        for stage, task_uuid in job.stage_uuids.items():
+            stage_status = self._ticket_status(task_uuid)
+            stage_status.pop('msg')
+            stages.update({stage: dict(stage_status, uuid=task_uuid)})
+        num_finished = sum(1 for state in list(job.states.values()) if state == 'finished')
+        job_status = {'msg': "Pipeline is running with uuid {}.".format(job_uuid),
+                      'state': job.state,
+                      'progressNum': "{}/{}".format(num_finished, len(job.states)),
+                      'stages': stages}
+        if job.pipeline.shards:
+            # mean progress of the shards, in percent as uploaded by parallel_map/imap_unordered
+            shard_progress = list()
+            for shard in job.pipeline.shards:
+                if job.states[shard] == 'finished':
+                    shard_progress.append(100.)
+                    continue
+                try:
+                    shard_progress.append(float(stages[shard].get('progressNum', 0)))
+                except (TypeError, ValueError):
+                    shard_progress.append(0.)
+            job_status.update({'msg': "Sharded job is running with uuid {}.".format(job_uuid),
+                               'shardProgress': round(sum(shard_progress) / len(shard_progress), 1)})
+        return job_status
+
+    def _stop_job(self, job_uuid: str) -> dict:
+        """
+        stop every stage of a pipeline run, the stages not submitted yet are cancelled as the stopped ones end
+        :param job_uuid: uuid of a running pipeline
+        :return: the result returned by DELETE
+        """
+        with self._job_lock:
+            job = self._jobs.get(job_uuid)
+            if job is None:
+                return {'msg': "No process linked to this uuid {}.".format(job_uuid)}
+            # cancel the stages not submitted yet first, so that a stopped stage does not unblock them
+            for stage in job.pipeline.order:
+                if stage not in job.submitted:
+                    job.submitted.add(stage)
+                    self._end_ticket(job.stage_uuids[stage], {'state': 'cancelled'})
+            for stage in job.pipeline.order:
+                if job.states[stage] is None:
+                    self._stop_ticket(job.stage_uuids[stage])
+        return {'msg': "Stop signal sent to this uuid {}.".format(job_uuid)}
+
+    def _request_stop(self, pid: int, reason: str) -> None:
+        """
+        set the stop flag of a running process, the controlling thread escalates if it does not exit in time
+        :param pid: the process to stop
+        :param reason: final state recorded for the ticket if the process ends because of this request
+        :return:
+        """
+        if pid in self._stop_requests or pid not in self._process_record:
+            return
+        self._stop_requests.update({pid: [self._backend.now(), reason, 0]})
+        self._backend.request_stop(self, pid)
+        # a suspended process can only see the stop flag once continued
+        for task_uuid, suspended_pid in list(self._suspended.items()):
+            if suspended_pid == pid:
+                if self._budget is not None:
+                    self._budget.acquire(self)
+                self._continue_ticket(task_uuid)
+
+    def _escalate_stop(self, process: Process) -> None:
+        """
+        called periodically by the controlling thread, escalates a pending stop request from the stop flag to SIGTERM
+        then to SIGKILL, each step after termination_grace_period seconds
+        :param process: the process being controlled
+        :return:
+        """
+        stop_request = self._stop_requests.get(process.pid)
+        if stop_request is None:
+            return
+        requested_time, reason, level = stop_request
+        elapsed = self._backend.now() - requested_time
+        if level == 0 and elapsed >= self._termination_grace_period:
+            self._logger.warning("Process {} ignored the stop flag ({}) for {:.1f}s, sending SIGTERM.".format(
+                process.pid, reason, elapsed))
+            signal_process_group(process.pid, signal.SIGTERM)
+            stop_request[2] = 1
+        elif level == 1 and elapsed >= 2 * self._termination_grace_period:
+            self._logger.warning("Process {} ignored SIGTERM ({}), sending SIGKILL.".format(process.pid, reason))
+            signal_process_group(process.pid, signal.SIGKILL)
+            stop_request[2] = 2
+
+    @classmethod
+    def _to_mb(cls, num_bytes: Optional[int]) -> Optional[float]:
+        return None if num_bytes is None else round(num_bytes / cls._MB, 1)
+
+    def _watching_memory(self):
+        """
+        periodically sample the resident set size of every worker along with its sub-workers, record the peak and
+        enforce the memory limits
+        :return:
+        """
+        while True:
+            time.sleep(self._memory_check_interval)
+            # processes of a remote agent are not on this host
+            local_pids = [pid for pid, process in list(self._process_record.items()) if process is not None]
+            process_groups = get_process_groups(local_pids)
+            for pid in local_pids:
+                rss = get_process_group_rss(pid, process_groups[pid])
+                if rss is None:
+                    continue
+                self._process_rss.update({pid: rss})
+                self._process_peak_rss.update({pid: max(rss, self._process_peak_rss.get(pid, 0))})
+                if self._memory_hard_limit is not None and rss > self._memory_hard_limit * self._MB \
+                        and self._stop_requests.get(pid, [None, None, 0])[2] < 2:
+                    self._logger.error("Process {} uses {}MB, above the hard limit {}MB, killing it.".format(
+                        pid, self._to_mb(rss), self._memory_hard_limit))
+                    self._stop_requests.update({pid: [self._backend.now(), 'memory', 2]})
+                    signal_process_group(pid, signal.SIGKILL)
+                elif self._memory_soft_limit is not None and rss > self._memory_soft_limit * self._MB \
+                        and pid not in self._stop_requests:
+                    self._logger.warning("Process {} uses {}MB, above the soft limit {}MB, stopping it.".format(
+                        pid, self._to_mb(rss), self._memory_soft_limit))
+                    self._request_stop(pid, 'memory')
+
+    def _cancel_ticket(self, task_uuid: str, state: str) -> bool:
+        """
+        cancel a ticket still waiting in the queue, the queue listener will discard it when popped
+        :param task_uuid: the ticket to cancel
+        :param state: final state recorded for the ticket
+        :return: False if the ticket has been taken out of the queue or cancelled already
+        """
+        # checked and marked in one step with the queue listener taking the ticket, see _take_waiting
+        with self._waiting_queue.mutex:
+            if task_uuid in self._ticket_control_relationship or task_uuid in self._cancelled_tickets:
+                return False
+            self._cancelled_tickets.update({task_uuid: state})
+        # the stages of a pipeline run share the payloads of the run, released once the run ended
+        if task_uuid not in self._ticket_job:
+            release_payloads(self._ticket_log.get(task_uuid, dict()))
+        self._end_ticket(task_uuid, {'state': state})
+        return True
+
+    def _end_ticket(self, task_uuid: str, final_state: dict) -> None:
+        """
+        record the final state of a ticket and fire the end callback
+        :param task_uuid: the ended ticket
+        :param final_state: dict with at least the `state` key, returned by GET afterwards
+        :return:
+        """
+        enqueue_time = self._ticket_enqueue_time.pop(task_uuid, None)
+        queue_wait = self._ticket_queue_wait.pop(task_uuid, None)
+        if enqueue_time is not None:
+            queue_wait = (queue_wait or 0.) + self._backend.now() - enqueue_time
+        if queue_wait is not None:
+            final_state.update({'queueWait': queue_wait})
+        self._ticket_task.pop(task_uuid, None)
+        self._ticket_history.update({task_uuid: final_state})
+        while len(self._ticket_history) > self._HISTORY_SIZE:
+            self._ticket_history.popitem(last=False)
+
+        if self._callback_url is not None:
+            callback_msg = {"msg": "Task with internal uuid {} ended".format(task_uuid),
+                            "uuid": task_uuid}
+            callback_msg.update(final_state)
+            send_request(self._callback_url, callback_msg)
+
+        self._backend.on_ticket_end(self, task_uuid, final_state)
+        if task_uuid in self._ticket_job:
+            self._on_stage_end(task_uuid, final_state['state'])
+
+    @staticmethod
+    def _parse_deadlines(kwargs: dict) -> Optional[str]:
+        """
+        convert `timeout` and `queue_timeout` of a POST request to seconds in place, before anything is queued, the
+        threads supervising the tickets only ever see numbers
+        :param kwargs: kwargs of the POST request
+        :return: an error message if one of them is not a number, None otherwise
+        """
+        for key in ('timeout', 'queue_timeout'):
+            if kwargs.get(key) is None:
+                continue
+            try:
+                kwargs[key] = float(kwargs[key])
+            except (TypeError, ValueError) as e:
+                return "Invalid {}: {}".format(key, e)
+        return None
+
+    def _queue_deadline(self, task_uuid: str) -> Optional[float]:
+        """
+        :param task_uuid: a ticket waiting in the queue
+        :return: the time after which the ticket expires, None if it never expires
+        """
+        queue_timeout = self._ticket_log.get(task_uuid, dict()).get('queue_timeout', self._queue_timeout)
+        enqueue_time = self._ticket_enqueue_time.get(task_uuid)
+        if queue_timeout is None or enqueue_time is None:
+            return None
+        return enqueue_time + float(queue_timeout)
+
+    def _watching_deadline(self):
+        """
+        periodically expire the tickets that have been waiting in the queue beyond their queue deadline,
+        deadlines of running tasks are handled by their controlling thread
+
+        the scheduled tickets are released to the queue and the stale snapshots are garbage collected by this thread
+        as well
+        :return:
+        """
+        last_snapshot_gc = self._backend.now()
+        while True:
+            time.sleep(self._SUPERVISE_INTERVAL)
+            now = self._backend.now()
+            # a ticket this thread fails on must not stop the others from being released and expired
+            try:
+                self._release_scheduled(now)
+            except Exception as e:
+                self._logger.exception("failed to release the scheduled tickets: {}".format(e))
+            if self._snapshots is not None and now - last_snapshot_gc >= self._SNAPSHOT_GC_INTERVAL:
+                try:
+                    self._snapshots.collect(list(self._ticket_log))
+                except Exception as e:
+                    self._logger.exception("failed to collect the stale snapshots: {}".format(e))
+                last_snapshot_gc = now
+            for task_uuid in list(self._ticket_enqueue_time):
+                try:
+                    self._expire_queued_ticket(task_uuid, now)
+                except Exception as e:
+                    self._logger.exception("failed to check the queue deadline of {}: {}".format(task_uuid, e))
+
+    def _expire_queued_ticket(self, task_uuid: str, now: float) -> None:
+        """
+        cancel a ticket waiting in the queue if its queue deadline has passed
+        :param task_uuid: any ticket
+        :param now: current time of the backend
+        :return:
+        """
+        if task_uuid not in self._ticket_enqueue_time or task_uuid in self._ticket_control_relationship \
+                or task_uuid in self._cancelled_tickets:
+            return
+        queue_deadline = self._queue_deadline(task_uuid)
+        if queue_deadline is not None and now >= queue_deadline and self._cancel_ticket(task_uuid, 'expired'):
+            self._logger.warning("Task with uuid {} expired in the queue.".format(task_uuid))
+
     def _listening_log(self):
         """
         the method is to listen the log_queue and handle the log by the listening(MainProcess) logger
@@ -294,14 +1163,19 @@ class MetaMPController(metaclass=abc.ABCMeta):
 
     def _create_control_thread(self, task_uuid: str) -> None:
         """
-        called by the queue listener thread to create a new control thread to execute task
+        called by the queue listener thread to hand a ticket to the backend, by default a new control thread
+        executing the task
         :return:
         """
         keyword_arguments = self._ticket_log[task_uuid]
-        post_thread = threading.Thread(target=self._running, args=(task_uuid, self._linking_task,),
-                                       kwargs=keyword_arguments, daemon=True, name='POST_THREAD')
-        post_thread.start()
-        self._ticket_control_relationship.update({task_uuid: post_thread.ident})
+        target_task = self._ticket_task.get(task_uuid, self._linking_task)
+        # the ticket leaves the queue, only the run time deadline applies from now on
+        enqueue_time = self._ticket_enqueue_time.pop(task_uuid, None)
+        if enqueue_time is not None:
+            self._ticket_queue_wait.update({task_uuid: self._ticket_queue_wait.get(task_uuid, 0.)
+                                            + self._backend.now() - enqueue_time})
+        control_ident = self._backend.launch(self, task_uuid, target_task, keyword_arguments)
+        self._ticket_control_relationship.update({task_uuid: control_ident})
 
     def _listening_queue(self):
         """
@@ -314,8 +1188,92 @@ class MetaMPController(metaclass=abc.ABCMeta):
             # 2. upon completion of one task
             self._waiting_queue_intake_event.wait()
             self._waiting_queue_intake_event.clear()
-            # position 0 is the priority, position 1 is the task uuid
-            task_uuid = self._waiting_queue.get(block=True)[1]
+            try:
+                self._dispatch_waiting()
+            except Exception as e:
+                self._logger.exception("failed to dispatch the waiting tickets: {}".format(e))
+
+    def _num_active(self) -> int:
+        """
+        :return: number of slots taken, by the dispatched tickets that are not suspended
+        """
+        return len(self._ticket_control_relationship) - len(self._suspended)
+
+    def _slot_limit(self) -> int:
+        """
+        :return: number of tickets this controller may run at once, max_num_process capped by its backend
+        """
+        return min(self._max_num_process, self._backend.capacity(self))
+
+    def _has_waiting_tickets(self) -> bool:
+        """
+        :return: True if tickets are waiting in the queue, used by the shared process budget
+        """
+        return self._waiting_queue.qsize() > len(self._cancelled_tickets)
+
+    def _ticket_priority(self, task_uuid: str):
+        return self._ticket_log.get(task_uuid, dict()).get("priority", 0)
+
+    def _peek_waiting(self) -> Optional[tuple]:
+        """
+        :return: (priority, order of arrival, task uuid) of the next ticket to dispatch, None if the queue is empty
+        """
+        with self._waiting_queue.mutex:
+            waiting = self._waiting_queue.queue
+            # drop the tickets cancelled or expired while waiting, only this thread takes tickets from the queue
+            while waiting and waiting[0][2] in self._cancelled_tickets:
+                task_uuid = heapq.heappop(waiting)[2]
+                self._cancelled_tickets.pop(task_uuid)
+                self._ticket_log.pop(task_uuid, None)
+                self._waiting_queue.not_full.notify()
+            return waiting[0] if waiting else None
+
+    def _take_waiting(self, head: tuple) -> bool:
+        """
+        take the ticket returned by _peek_waiting out of the queue, if it is still the next one and has not been
+        cancelled meanwhile, from then on it takes a slot and can no longer be cancelled, see _cancel_ticket
+        :param head: the entry returned by _peek_waiting
+        :return: False if the queue changed since it was peeked
+        """
+        with self._waiting_queue.mutex:
+            waiting = self._waiting_queue.queue
+            if not waiting or waiting[0] != head or head[2] in self._cancelled_tickets:
+                return False
+            heapq.heappop(waiting)
+            self._waiting_queue.not_full.notify()
+            # the control ident is set once the backend launched the ticket
+            self._ticket_control_relationship.update({head[2]: None})
+        return True
+
+    def _dispatch_waiting(self) -> None:
+        """
+        called by the queue listener thread, fill the free slots with the suspended tasks and the waiting tickets,
+        most urgent first, preempting a running task for an urgent ticket if there is no free slot
+        :return:
+        """
+        while True:
+            head = self._peek_waiting()
+            if self._num_active() >= self._slot_limit():
+                # a suspended task frees its slot right away, go on dispatching
+                if head is not None and self._preempt_for(head[0]):
+                    continue
+                return
+            if head is None and not self._suspended:
+                return
+            # the shared budget wakes this thread up again when a slot is given back
+            if self._budget is not None and not self._budget.try_acquire(self):
+                return
+            if self._suspended:
+                suspended_uuid = min(self._suspended, key=self._ticket_priority)
+                if head is None or self._ticket_priority(suspended_uuid) <= head[0]:
+                    self._continue_ticket(suspended_uuid)
+                    continue
+            if not self._take_waiting(head):
+                if self._budget is not None:
+                    self._budget.release(self)
+                continue
+            # position 0 is the priority, position 1 the order of arrival, position 2 the task uuid
+            task_uuid = head[2]
             self._create_control_thread(task_uuid)
 
             if self._callback_url is not None:
@@ -323,6 +1281,114 @@ class MetaMPController(metaclass=abc.ABCMeta):
                                 "uuid": task_uuid}
                 send_request(self._callback_url, callback_msg)
 
+    def _preempt_for(self, priority) -> bool:
+        """
+        preempt a running task for a waiting ticket, following the preemption policy
+        :param priority: priority of the waiting ticket
+        :return: True if a slot is free now, False if there is nothing to preempt or the slot frees up later
+        """
+        if self._preemption_priority is None or priority > self._preemption_priority or self._preempting:
+            return False
+        candidates = list()
+        for task_uuid in list(self._ticket_control_relationship):
+            pid = self._ticket_process(task_uuid)
+            if pid is None or task_uuid in self._suspended or pid in self._stop_requests \
+                    or self._ticket_priority(task_uuid) <= priority:
+                continue
+            self._refresh_progress(pid)
+            try:
+                progress = float(self._process_progress.get(pid, 0))
+            except (TypeError, ValueError):
+                progress = 0.
+            candidates.append((task_uuid, pid, progress))
+        if not candidates:
+            return False
+        # the least urgent first, then the least advanced
+        victim_uuid, victim_pid, _ = min(candidates, key=lambda candidate: (-self._ticket_priority(candidate[0]),
+                                                                            candidate[2]))
+        self._preemption_counter += 1
+        self._ticket_preemptions.update({victim_uuid: self._ticket_preemptions.get(victim_uuid, 0) + 1})
+        self._logger.info("Task with uuid {} preempted ({}) for a ticket with priority {}.".format(
+            victim_uuid, self._preemption_policy, priority))
+        if self._preemption_policy == 'suspend':
+            self._suspend_ticket(victim_uuid, victim_pid)
+            return True
+        self._preempting.add(victim_uuid)
+        self._request_stop(victim_pid, 'preempted')
+        return False
+
+    def _suspend_ticket(self, task_uuid: str, pid: int) -> None:
+        """
+        pause a running process with SIGSTOP and lend its core set to the other workers
+        :param task_uuid: the ticket to suspend
+        :param pid: the process running the ticket
+        :return:
+        """
+        self._backend.suspend(self, pid)
+        self._suspended.update({task_uuid: pid})
+        # the run time deadline does not run while suspended
+        run_deadline = self._run_deadlines.pop(pid, None)
+        if run_deadline is not None:
+            self._paused_run_time.update({pid: run_deadline - self._backend.now()})
+        if self._budget is not None:
+            self._budget.release(self)
+        cpu_set = self._process_placement.get(pid, (None, None))[0]
+        if cpu_set is not None:
+            self._release_core_set(cpu_set)
+            self._lent_core_sets.update({pid: cpu_set})
+
+    def _continue_ticket(self, task_uuid: str) -> None:
+        """
+        continue a suspended process with SIGCONT, on a core set free at this time
+        :param task_uuid: the suspended ticket
+        :return:
+        """
+        pid = self._suspended.pop(task_uuid, None)
+        if pid is None:
+            return
+        if self._lent_core_sets.pop(pid, None) is not None:
+            cpu_set = self._acquire_core_set()
+            self._process_placement.update({pid: (cpu_set, self._process_placement[pid][1])})
+            # every thread of the process and of its sub-workers keeps its own mask
+            try:
+                for member in get_process_groups([pid])[pid] or [pid]:
+                    for thread_id in os.listdir('/proc/{}/task'.format(member)):
+                        os.sched_setaffinity(int(thread_id), cpu_set)
+            except OSError as e:
+                self._logger.warning("failed to move process {} to cpus {}: {}".format(pid, cpu_set, e))
+        paused_run_time = self._paused_run_time.pop(pid, None)
+        if paused_run_time is not None:
+            self._run_deadlines.update({pid: self._backend.now() + paused_run_time})
+        self._backend.resume(self, pid)
+
+    def _task_context(self, task_uuid: str, target_task: type(MetaMPTask), kwargs: dict) -> dict:
+        """
+        called when a ticket starts, record it in the snapshot store and locate its files
+        :param task_uuid: the starting ticket
+        :param target_task: the task class of the ticket
+        :param kwargs: kwargs of the ticket
+        :return: kwargs of the task object besides its primitives and placement
+        """
+        # pipeline stages exchange their outputs through the files of the pipeline run
+        # a shard also gets its position in the sharded job
+        output_path, input_paths, shard_index, num_shards, reduce_stage = None, None, None, None, False
+        with self._job_lock:
+            job = self._jobs.get(self._ticket_job.get(task_uuid))
+            if job is not None:
+                stage = job.stages[task_uuid]
+                output_path = job.output_path(stage)
+                input_paths = job.input_paths(stage)
+                if stage in job.pipeline.shards:
+                    shard_index, num_shards = job.pipeline.shards.index(stage), len(job.pipeline.shards)
+                reduce_stage = stage == job.pipeline.reduce_stage
+        # record the ticket in the snapshot store so that it can be resumed, even after a restart
+        state_path = None
+        if self._snapshots is not None:
+            self._snapshots.save_ticket(task_uuid, target_task, kwargs)
+            state_path = self._snapshots.state_path(task_uuid)
+        return {'output_path': output_path, 'input_paths': input_paths, 'state_path': state_path,
+                'shard_index': shard_index, 'num_shards': num_shards, 'reduce_stage': reduce_stage}
+
     def _running(self, task_uuid: str, target_task: type(MetaMPTask), *args, **kwargs) -> None:
         """
         this method is called by the controlling thread to create, run and control the calculating process to execute
@@ -347,42 +1413,175 @@ class MetaMPController(metaclass=abc.ABCMeta):
         parent_connection, child_connection = multiprocessing.Pipe(duplex=False)
         new_lock = multiprocessing.Lock()
 
+        # pick the core set and the thread count the worker will be placed with
+        cpu_set = self._acquire_core_set()
+        num_threads = self._num_threads
+        if num_threads is None and cpu_set is not None:
+            num_threads = len(cpu_set)
+        # pin the current versions of the shared datasets for the whole run
+        datasets = self._datasets.acquire()
+        task_context = self._task_context(task_uuid, target_task, kwargs)
+
         # maintaining the counter in the controller instead of the task for it will get instantiated every time
         target_task.counter += 1
         # set running process to daemon in case that the running process may be orphaned
         # after the main process exit exceptionally
         task_obj = target_task(*(new_event, child_connection, new_lock, self._log_queue, target_task.counter,
-                                 self._log_configurator) + args)
-        new_process = multiprocessing.Process(target=task_obj.execute,
+                                 self._log_configurator) + args, cpu_set=cpu_set, num_threads=num_threads,
+                               core_budget=self._core_budget(cpu_set), datasets=datasets, **task_context)
+        new_process = multiprocessing.Process(target=task_obj.run,
                                               name=str(task_obj.task_name) + '-' + str(target_task.counter),
                                               args=args, kwargs=kwargs, daemon=True)
         # create another process and run
-        new_process.start()
+        self._start_process(new_process, cpu_set, num_threads)
+        # the worker leads a process group of its own, along with its sub-workers, see MetaMPTask._lead_process_group
+        # it is moved from both sides so that the group is in place whichever side runs first
+        try:
+            os.setpgid(new_process.pid, new_process.pid)
+        except OSError:
+            pass
         # after process ID(pid) has been generated, log the thread, process and its primitives info
-        self._process_record.update({new_process.pid: new_process})
         self._process_primitives.update({new_process.pid: (new_event, parent_connection, new_lock)})
+        self._process_record.update({new_process.pid: new_process})
+        self._process_placement.update({new_process.pid: (cpu_set, num_threads)})
         self._control_relationship.update({threading.current_thread().ident: new_process.pid})
 
         # hold until the controlled process exit either normally or forcefully
-        new_process.join()
+        # meanwhile enforce the run time deadline and escalate the stop requests the process does not respond to
+        try:
+            self._start_run_deadline(new_process.pid, kwargs)
+            while True:
+                new_process.join(self._SUPERVISE_INTERVAL)
+                if not new_process.is_alive():
+                    break
+                if self._run_deadline_passed(new_process.pid):
+                    self._request_stop(new_process.pid, 'timeout')
+                self._escalate_stop(new_process)
+        except Exception as e:
+            # never leave a process running unsupervised, its slot would never be given back
+            self._logger.exception("failed to supervise process {}, killing it: {}".format(new_process.pid, e))
+            signal_process_group(new_process.pid, signal.SIGKILL)
+            new_process.join()
+        # sub-workers never outlive their task, even if it crashed or has been killed
+        try:
+            os.killpg(new_process.pid, signal.SIGKILL)
+        except OSError:
+            pass
 
         # clean procedure for Pipe, Event and Lock
         while parent_connection.poll():
             parent_connection.recv()
         parent_connection.close()
         self._process_primitives.pop(new_process.pid)
+        final_state = self._final_state(new_process.exitcode, self._stop_requests.pop(new_process.pid, None))
+        self._clear_run_deadline(new_process.pid)
+        self._process_rss.pop(new_process.pid, None)
+        final_state.update({'peakRssMb': self._to_mb(self._process_peak_rss.pop(new_process.pid, None))})
 
         # clean procedure for all the records
         self._process_record.pop(new_process.pid)
         self._process_progress.pop(new_process.pid, None)
+        # the core set may have changed since start if the process has been suspended
+        cpu_set = self._process_placement.pop(new_process.pid, (None, None))[0]
+        if self._lent_core_sets.pop(new_process.pid, None) is None:
+            self._release_core_set(cpu_set)
+        self._datasets.release(datasets)
         self._control_relationship.pop(threading.current_thread().ident)
+        self._release_ticket(task_uuid, target_task, kwargs, final_state)
+
+    def _start_run_deadline(self, pid: int, kwargs: dict) -> Optional[float]:
+        """
+        start the run time deadline of a process, `timeout` of the ticket or task_timeout, called by the backend
+        :param pid: the process running the ticket
+        :param kwargs: kwargs of the ticket
+        :return: the deadline, None if the ticket has no time limit
+        """
+        task_timeout = kwargs.get('timeout', self._task_timeout)
+        if task_timeout is None:
+            return None
+        self._run_deadlines.update({pid: self._backend.now() + float(task_timeout)})
+        return self._run_deadlines[pid]
+
+    def _run_deadline_passed(self, pid: int) -> bool:
+        """
+        :param pid: a running process
+        :return: True if its run time deadline has passed, never while it is suspended
+        """
+        run_deadline = self._run_deadlines.get(pid)
+        return run_deadline is not None and self._backend.now() >= run_deadline
+
+    def _clear_run_deadline(self, pid: int) -> None:
+        self._run_deadlines.pop(pid, None)
+        self._paused_run_time.pop(pid, None)
+
+    def _release_ticket(self, task_uuid: str, target_task: type(MetaMPTask), kwargs: dict, final_state: dict) -> None:
+        """
+        called by the backend once the process of a ticket is gone, frees the slot of the ticket and ends it, or
+        requeues it if it has been preempted
+        :param task_uuid: the ticket
+        :param target_task: the task class the ticket ran
+        :param kwargs: kwargs of the ticket
+        :param final_state: how the process ended, see _final_state
+        :return:
+        """
         self._ticket_log.pop(task_uuid)
+        # a process killed while suspended has given its slot back already
+        if self._suspended.pop(task_uuid, None) is None and self._budget is not None:
+            self._budget.release(self)
+        self._preempting.discard(task_uuid)
+        # a preempted ticket, or one lost with the remote agent running it, goes back to the queue with its
+        # snapshot and payloads
+        preempted = final_state['state'] in ('preempted', 'lost')
+        if self._ticket_preemptions.get(task_uuid):
+            final_state.update({'preemptions': self._ticket_preemptions[task_uuid]})
+        if preempted:
+            pass
+        elif self._snapshots is not None and final_state['state'] != 'finished':
+            # keep the snapshot and the payloads for the ticket to be resumed
+            final_state.update({'resumable': True})
+        else:
+            if self._snapshots is not None:
+                self._snapshots.discard(task_uuid)
+            # the stages of a pipeline run share the payloads of the run, released once the run ended
+            if task_uuid not in self._ticket_job:
+                release_payloads(kwargs)
         self._ticket_control_relationship.pop(task_uuid)
 
+        if preempted:
+            # requeued under the same uuid, it resumes from its last snapshot if snapshots are enabled
+            # the ticket has been accepted already, it goes back even if the queue filled up in the meantime
+            if final_state['state'] == 'lost':
+                self._logger.warning("Task with uuid {} lost with its agent, put back in the queue.".format(task_uuid))
+            self._enqueue_ticket(task_uuid, kwargs, target_task if target_task is not self._linking_task else None,
+                                 admitted=True)
+            return
+
         # after a task is complete, there always a room for a new task to be executed
         self._waiting_queue_intake_event.set()
 
-        if self._callback_url is not None:
-            callback_msg = {"msg": "Task with internal uuid {} ended".format(task_uuid),
-                            "uuid": task_uuid}
-            send_request(self._callback_url, callback_msg)
+        self._ticket_preemptions.pop(task_uuid, None)
+        self._end_ticket(task_uuid, final_state)
+
+    @staticmethod
+    def _final_state(exit_code: Optional[int], stop_request: Optional[list]) -> dict:
+        """
+        summarize how an exited process ended
+
+        the reason of a stop request is only recorded if the process ended because of it, stopping at a checkpoint
+        or killed by a signal, a process that finished or failed on its own meanwhile is recorded as such
+        :param exit_code: exit code of the process, negative if it was killed by a signal
+        :param stop_request: the stop request sent to the process if any, see _request_stop
+        :return: dict with the final `state`, the `exitCode` and the stop `escalation` step that ended the process
+        """
+        stopped = exit_code == ABORT_EXIT_CODE or (exit_code is not None and exit_code < 0)
+        if stopped and stop_request is not None:
+            state = stop_request[1]
+            escalation = ('stop flag', 'SIGTERM', 'SIGKILL')[stop_request[2]]
+        elif exit_code == ABORT_EXIT_CODE:
+            # AbortException raised by the task itself
+            state = 'aborted'
+            escalation = None
+        else:
+            state = 'finished' if exit_code == 0 else 'failed'
+            escalation = None
+        return {'state': state, 'exitCode': exit_code, 'escalation': escalation}
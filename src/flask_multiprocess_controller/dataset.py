@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_multiprocess_controller.dataset
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module implements the registry of read-only datasets shared by all the tasks of a controller. A dataset is
+    written (or mapped) once by the controller and mapped read-only by every task without copying it.
+
+    :copyright: 2022 Yuhao Wang
+    :license: BSD-3-Clause
+"""
+
+import atexit
+import logging
+import os
+import tempfile
+import threading
+from typing import Any, Callable, Dict, Optional
+
+from .payload import DEFAULT_SPOOL_DIR, PayloadHandle
+
+logger = logging.getLogger(__name__)
+
+
+class DatasetHandle(PayloadHandle):
+    """
+    picklable reference to one version of a shared dataset, the dataset file is owned by the DatasetRegistry
+    """
+
+    def __init__(self, name: str, version: int, path: str, size: int, content_type: str = None,
+                 owned: bool = True):
+        super(DatasetHandle, self).__init__(path, size, content_type)
+        self.name: str = name
+        self.version: int = version
+        # files registered by path belong to the user and are never removed
+        self.owned: bool = owned
+
+    def __repr__(self):
+        return "<DatasetHandle {} v{} ({} bytes, {})>".format(self.name, self.version, self.size, self.content_type)
+
+    def load(self) -> Any:
+        """
+        :return: read-only NumPy array for .npy datasets, read-only memoryview otherwise
+        """
+        if self.content_type == 'application/x-npy':
+            return self.as_numpy()
+        return self.buffer()
+
+
+class DatasetRegistry(object):
+    """
+    named datasets shared read-only by the tasks of a controller
+
+    every running task holds a reference on the versions it started with, refreshing a dataset publishes a new
+    version to the tasks started afterwards, the previous version is removed once the last task using it ended
+    """
+
+    def __init__(self, spool_dir: str = None):
+        self._spool_dir: str = spool_dir or DEFAULT_SPOOL_DIR
+        self._lock = threading.Lock()
+        self._current: Dict[str, DatasetHandle] = dict()
+        # (name, version) -> [handle, reference count]
+        self._versions: Dict[tuple, list] = dict()
+        # last version published under each name, it never goes back, even once the dataset is unregistered, so that
+        # a new version never takes the record of an old one still used by a running task
+        self._last_versions: Dict[str, int] = dict()
+        # the spool files outlive the process unless removed
+        atexit.register(self.close)
+
+    def register(self, name: str, data: Any = None, path: str = None,
+                 loader: Callable[[], Any] = None) -> DatasetHandle:
+        """
+        publish a new version of a dataset, replacing the current one if any
+        :param name: name of the dataset
+        :param data: NumPy array or bytes-like object, written once to the spool directory
+        :param path: existing file to map as is (.npy files are mapped as NumPy arrays), it is never removed
+        :param loader: callable returning data, called once
+        :return: handle of the new version
+        """
+        assert (data is not None) + (path is not None) + (loader is not None) == 1, \
+            "exactly one of data, path or loader should be given for dataset {}".format(name)
+        if loader is not None:
+            data = loader()
+        with self._lock:
+            version = self._last_versions.get(name, 0) + 1
+            self._last_versions.update({name: version})
+        if path is not None:
+            content_type = 'application/x-npy' if path.endswith('.npy') else 'application/octet-stream'
+            handle = DatasetHandle(name, version, path, os.path.getsize(path), content_type, owned=False)
+        else:
+            handle = self._write(name, version, data)
+
+        with self._lock:
+            previous = self._current.get(name)
+            self._current.update({name: handle})
+            self._versions.update({(name, version): [handle, 1]})
+        if previous is not None:
+            self._unref(previous)
+        logger.info("dataset {} published as version {}".format(name, version))
+        return handle
+
+    def unregister(self, name: str) -> None:
+        """
+        withdraw a dataset, running tasks keep the version they started with
+        :param name: name of the dataset
+        :return:
+        """
+        with self._lock:
+            handle = self._current.pop(name, None)
+        if handle is not None:
+            self._unref(handle)
+
+    def acquire(self) -> Dict[str, DatasetHandle]:
+        """
+        take a reference on the current version of every dataset, called when a task starts
+        :return: dataset name -> handle
+        """
+        with self._lock:
+            for handle in self._current.values():
+                self._versions[(handle.name, handle.version)][1] += 1
+            return dict(self._current)
+
+    def release(self, handles: Dict[str, DatasetHandle]) -> None:
+        """
+        drop the references taken by acquire, called when a task ended
+        :param handles: the dict returned by acquire
+        :return:
+        """
+        for handle in handles.values():
+            self._unref(handle)
+
+    def describe(self) -> dict:
+        """
+        :return: name -> version, size and number of references of the current version
+        """
+        with self._lock:
+            return {name: {'version': handle.version, 'size': handle.size,
+                           'refCount': self._versions[(name, handle.version)][1] - 1}
+                    for name, handle in self._current.items()}
+
+    def close(self) -> None:
+        """
+        remove the files of every version, called at exit
+        :return:
+        """
+        with self._lock:
+            handles = [record[0] for record in self._versions.values()]
+            self._current.clear()
+            self._versions.clear()
+        for handle in handles:
+            if handle.owned:
+                handle.release()
+
+    def _write(self, name: str, version: int, data: Any) -> DatasetHandle:
+        """
+        write data once into a file of the spool directory, NumPy arrays as .npy, anything else as raw bytes
+        :return: handle of the written file
+        """
+        fd, path = tempfile.mkstemp(prefix='mp-dataset-{}-v{}-'.format(name, version), dir=self._spool_dir)
+        try:
+            with os.fdopen(fd, 'wb') as dataset_file:
+                if type(data).__module__ == 'numpy' and hasattr(data, 'dtype'):
+                    import numpy
+                    numpy.save(dataset_file, data, allow_pickle=False)
+                    content_type = 'application/x-npy'
+                else:
+                    dataset_file.write(memoryview(data))
+                    content_type = 'application/octet-stream'
+                size = dataset_file.tell()
+        except BaseException:
+            os.unlink(path)
+            raise
+        return DatasetHandle(name, version, path, size, content_type)
+
+    def _unref(self, handle: DatasetHandle) -> None:
+        """
+        drop a reference on a dataset version, remove its file when nothing uses it anymore
+        :param handle: the version to drop
+        :return:
+        """
+        with self._lock:
+            record: Optional[list] = self._versions.get((handle.name, handle.version))
+            if record is None:
+                return
+            record[1] -= 1
+            if record[1] > 0:
+                return
+            self._versions.pop((handle.name, handle.version))
+        if handle.owned:
+            handle.release()
+        logger.info("dataset {} version {} retired".format(handle.name, handle.version))
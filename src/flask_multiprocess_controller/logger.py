@@ -46,6 +46,10 @@ class MetaMPLoggerConfigurator(metaclass=abc.ABCMeta):
         :return:
         """
         logger = logging.getLogger('MAIN_WORKER')
+        # the handler may have been inherited already, e.g. by the sub-workers forked from a task
+        if any(isinstance(handler, logging.handlers.QueueHandler) and handler.queue is queue
+               for handler in logger.handlers):
+            return
         queue_handler = logging.handlers.QueueHandler(queue)
         queue_handler.setFormatter(logging.Formatter('%(message)s'))
         logger.addHandler(queue_handler)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_multiprocess_controller.payload
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module implements the handle of large or binary request bodies spooled to a file, so that only a small
+    reference is kept in the controller's ticket and passed to the worker process, which maps the data without
+    copying it.
+
+    :copyright: 2022 Yuhao Wang
+    :license: BSD-3-Clause
+"""
+
+import json
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+from typing import Any, BinaryIO, Optional
+
+logger = logging.getLogger(__name__)
+
+# /dev/shm is a memory backed file system, spooled bodies there never reach the disk
+DEFAULT_SPOOL_DIR: str = '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) \
+    else tempfile.gettempdir()
+
+
+class PayloadHandle(object):
+    """
+    picklable reference to a request body spooled to a file
+
+    the file is owned by the controller, it is removed when the ticket ends
+    """
+
+    _CHUNK_SIZE: int = 1024 * 1024
+
+    def __init__(self, path: str, size: int, content_type: str = None):
+        self.path: str = path
+        self.size: int = size
+        self.content_type: Optional[str] = content_type
+        self._mmap: Optional[mmap.mmap] = None
+
+    def __getstate__(self):
+        # the mapping belongs to the process that created it
+        state = self.__dict__.copy()
+        state['_mmap'] = None
+        return state
+
+    def __repr__(self):
+        return "<PayloadHandle {} ({} bytes, {})>".format(self.path, self.size, self.content_type)
+
+    @classmethod
+    def spool(cls, stream: BinaryIO, content_type: str = None, spool_dir: str = None) -> 'PayloadHandle':
+        """
+        stream a request body into a new spool file, chunk by chunk
+        :param stream: readable binary stream of the body
+        :param content_type: mimetype of the body
+        :param spool_dir: directory of the spool file, by default /dev/shm if available, else the temp directory
+        :return: the handle of the spooled body
+        """
+        fd, path = tempfile.mkstemp(prefix='mp-payload-', dir=spool_dir or DEFAULT_SPOOL_DIR)
+        try:
+            with os.fdopen(fd, 'wb') as spool_file:
+                shutil.copyfileobj(stream, spool_file, cls._CHUNK_SIZE)
+                size = spool_file.tell()
+        except BaseException:
+            os.unlink(path)
+            raise
+        return cls(path, size, content_type)
+
+    def open(self) -> BinaryIO:
+        """
+        :return: the spooled body as a binary file object
+        """
+        return open(self.path, 'rb')
+
+    def buffer(self) -> memoryview:
+        """
+        map the spooled body read-only into memory without copying it
+        :return: read-only memoryview over the body
+        """
+        if self.size == 0:
+            return memoryview(b'')
+        if self._mmap is None:
+            with open(self.path, 'rb') as payload_file:
+                self._mmap = mmap.mmap(payload_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._mmap)
+
+    def as_numpy(self, dtype: Any = 'uint8', shape: tuple = None) -> Any:
+        """
+        zero-copy read-only NumPy view of the body, requires numpy
+        :param dtype: element type of raw bodies, ignored for .npy bodies (application/x-npy)
+        :param shape: shape of raw bodies, flat by default, ignored for .npy bodies
+        :return: numpy.ndarray backed by the spooled file
+        """
+        import numpy
+        if self.content_type == 'application/x-npy':
+            return numpy.load(self.path, mmap_mode='r')
+        array = numpy.frombuffer(self.buffer(), dtype=dtype)
+        return array if shape is None else array.reshape(shape)
+
+    def json(self) -> Any:
+        """
+        :return: the body decoded as JSON
+        """
+        with self.open() as payload_file:
+            return json.load(payload_file)
+
+    def release(self) -> None:
+        """
+        remove the spool file, called by the controller once the ticket ended
+        :return:
+        """
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("failed to remove payload {}: {}".format(self.path, e))
+
+
+def release_payloads(kwargs: dict) -> None:
+    """
+    remove the spool files of the payload handles among the ticket's kwargs
+    :param kwargs: kwargs of a ticket
+    :return:
+    """
+    for value in kwargs.values():
+        if isinstance(value, PayloadHandle):
+            value.release()
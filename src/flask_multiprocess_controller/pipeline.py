@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_multiprocess_controller.pipeline
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module implements pipelines, small DAGs of MPTask stages submitted to the MPController at once. The controller
+    queues each stage as soon as its upstream stages finished and passes the stage outputs through local files.
+
+    A sharded job is a pipeline of shards running the same task in parallel, followed by a reduce stage.
+
+    :copyright: 2022 Yuhao Wang
+    :license: BSD-3-Clause
+"""
+
+import os
+import uuid
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from .task import MetaMPTask
+
+
+class Pipeline(object):
+    """
+    validated definition of a DAG of stages, each stage being a MetaMPTask subclass and its upstream stage names
+    """
+
+    def __init__(self, stages: Dict[str, Tuple[type(MetaMPTask), Iterable[str]]]):
+        assert len(stages) > 0, "a pipeline needs at least one stage"
+        self.tasks: Dict[str, type(MetaMPTask)] = dict()
+        self.upstream: Dict[str, Tuple[str, ...]] = dict()
+        for stage, (target_task, upstream) in stages.items():
+            assert isinstance(target_task, type) and issubclass(target_task, MetaMPTask), \
+                "Invalid class {} for stage {}, it must inherit from MetaMPTask".format(target_task, stage)
+            self.tasks.update({stage: target_task})
+            self.upstream.update({stage: tuple(upstream)})
+        # shard stages in order and the reduce stage over their outputs, only set for a sharded job
+        self.shards: Tuple[str, ...] = tuple()
+        self.reduce_stage: Optional[str] = None
+        for stage, upstream in self.upstream.items():
+            unknown = set(upstream) - set(self.tasks)
+            assert not unknown, "stage {} depends on unknown stages {}".format(stage, unknown)
+        self.order: List[str] = self._topological_order()
+
+    @classmethod
+    def sharded(cls, target_task: type(MetaMPTask), num_shards: int) -> 'Pipeline':
+        """
+        :param target_task: task class running every shard and the reduce stage
+        :param num_shards: number of shards
+        :return: pipeline of the shards `shard-<index>` followed by the stage `reduce`
+        """
+        assert num_shards > 0, "a sharded job needs at least one shard, passing {}".format(num_shards)
+        shards = tuple('shard-{}'.format(shard_index) for shard_index in range(num_shards))
+        stages = {shard: (target_task, ()) for shard in shards}
+        stages.update({'reduce': (target_task, shards)})
+        pipeline = cls(stages)
+        pipeline.shards = shards
+        pipeline.reduce_stage = 'reduce'
+        return pipeline
+
+    def _topological_order(self) -> List[str]:
+        """
+        :return: the stages sorted so that every stage comes after its upstream stages
+        """
+        order, done = list(), set()
+        while len(order) < len(self.tasks):
+            ready = [stage for stage in self.tasks
+                     if stage not in done and all(upstream in done for upstream in self.upstream[stage])]
+            assert ready, "pipeline stages {} form a cycle".format(set(self.tasks) - done)
+            order.extend(ready)
+            done.update(ready)
+        return order
+
+
+class PipelineRun(object):
+    """
+    state of one submission of a pipeline, the job uuid identifies the whole run
+    """
+
+    def __init__(self, pipeline: Pipeline, kwargs: dict, work_dir: str, job_uuid: str = None,
+                 stage_kwargs: Dict[str, dict] = None):
+        self.pipeline: Pipeline = pipeline
+        # kwargs passed to every stage, updated with the kwargs of the stage if any
+        self.kwargs: dict = kwargs
+        self.stage_kwargs: Dict[str, dict] = stage_kwargs or dict()
+        self.work_dir: str = work_dir
+        self.job_uuid: str = job_uuid or str(uuid.uuid4())
+        self.stage_uuids: Dict[str, str] = {stage: str(uuid.uuid4()) for stage in pipeline.order}
+        self.stages: Dict[str, str] = {task_uuid: stage for stage, task_uuid in self.stage_uuids.items()}
+        # final state of each stage, None while it has not ended
+        self.states: Dict[str, Optional[str]] = {stage: None for stage in pipeline.order}
+        self.submitted: Set[str] = set()
+
+    def ready_stages(self) -> List[str]:
+        """
+        :return: the stages not submitted yet whose upstream stages all finished
+        """
+        return [stage for stage in self.pipeline.order if stage not in self.submitted and
+                all(self.states[upstream] == 'finished' for upstream in self.pipeline.upstream[stage])]
+
+    def kwargs_of(self, stage: str) -> dict:
+        return dict(self.kwargs, **self.stage_kwargs.get(stage, dict()))
+
+    def output_path(self, stage: str) -> str:
+        return os.path.join(self.work_dir, '{}.pkl'.format(stage))
+
+    def input_paths(self, stage: str) -> Dict[str, str]:
+        return {upstream: self.output_path(upstream) for upstream in self.pipeline.upstream[stage]}
+
+    @property
+    def ended(self) -> bool:
+        return all(state is not None for state in self.states.values())
+
+    @property
+    def state(self) -> str:
+        """
+        :return: `finished` if every stage finished, else the final state of the first stage that did not
+        """
+        for stage in self.pipeline.order:
+            if self.states[stage] not in (None, 'finished'):
+                return self.states[stage]
+        return 'finished' if self.ended else 'running'
@@ -12,21 +12,78 @@
     :license: BSD-3-Clause
 """
 
-import inspect
 import json
 
-from flask import request
+from collections import OrderedDict
+from typing import Optional
+from flask import request, make_response
 from flask_restful import Resource
+from flask_restful.representations.json import output_json
 
 from .controller import MetaMPController
+from .payload import PayloadHandle
+
+# optional faster codecs, installed with the `fast` extra
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def output_orjson(data, code, headers=None):
+    """flask-RESTful representation serializing the response with orjson"""
+    resp = make_response(orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS), code)
+    resp.headers.extend(headers or {})
+    return resp
+
+
+def output_msgpack(data, code, headers=None):
+    """flask-RESTful representation serializing the response with msgpack"""
+    resp = make_response(msgpack.packb(data), code)
+    resp.headers.extend(headers or {})
+    return resp
+
+
+def _build_decoders() -> dict:
+    decoders = {'': orjson.loads if orjson is not None else json.loads}
+    # plain text bodies have always been decoded as JSON
+    decoders.update({mimetype: decoders[''] for mimetype in ('application/json', 'text/plain')})
+    if msgpack is not None:
+        decoders.update({mimetype: msgpack.unpackb for mimetype in ('application/msgpack', 'application/x-msgpack')})
+    return decoders
+
+
+def _build_representations() -> OrderedDict:
+    # the first one is the default when the client accepts anything
+    representations = OrderedDict({'application/json': output_orjson if orjson is not None else output_json})
+    if msgpack is not None:
+        representations.update({'application/msgpack': output_msgpack})
+    return representations
 
 
 class MetaMPResource(Resource):
     """
     overridden resource class to take BasicController as its controller, and execute controller's method when get
     http request from WSGI server
+
+    JSON (or msgpack) bodies are decoded into the controller's kwargs, the bodies of POST requests of other content
+    types, and decodable ones larger than payload_threshold bytes if it is set, are spooled to a file under spool_dir
+    and passed as the `payload` kwarg (a PayloadHandle), along with the query string parameters
+
+    responses are encoded according to the Accept header, JSON by default, with orjson/msgpack when installed
     """
 
+    # None to decode every JSON (or msgpack) body, whatever its size
+    payload_threshold: Optional[int] = None
+    spool_dir: str = None
+    # request content type -> decoder of the body into the controller's kwargs
+    decoders: dict = _build_decoders()
+    representations = _build_representations()
+
     def __init__(self, controller: MetaMPController):
         super(MetaMPResource, self).__init__()
         self._controller = controller
@@ -34,47 +91,58 @@ class MetaMPResource(Resource):
     # all supported http methods are predefined to linked to the _controller object
 
     def get(self):
-        return self.__return_controller_func()
+        return self.__return_controller_func('get')
 
     def post(self):
-        return self.__return_controller_func()
+        return self.__return_controller_func('post')
 
     def head(self):
-        return self.__return_controller_func()
+        return self.__return_controller_func('head')
 
     def options(self):
-        return self.__return_controller_func()
+        return self.__return_controller_func('options')
 
     def delete(self):
-        return self.__return_controller_func()
+        return self.__return_controller_func('delete')
 
     def put(self):
-        return self.__return_controller_func()
+        return self.__return_controller_func('put')
 
     def trace(self):
-        return self.__return_controller_func()
+        return self.__return_controller_func('trace')
 
     def patch(self):
-        return self.__return_controller_func()
+        return self.__return_controller_func('patch')
 
-    @staticmethod
-    def _get_request_dict(request_obj: request) -> dict:
+    @classmethod
+    def _get_request_dict(cls, request_obj: request) -> dict:
         """
         transform http request input to dict object
 
         :param request_obj:
         :return:
         """
+        content_length = request_obj.content_length or 0
+        decoder = cls.decoders.get(request_obj.mimetype)
+        oversized = cls.payload_threshold is not None and content_length > cls.payload_threshold
+        # only a POST queues a ticket, which releases the spool file once it ended, see release_payloads
+        if request_obj.method == 'POST' and (oversized or (content_length and decoder is None)):
+            # do not touch request_obj.data, it would read the whole body in memory
+            request_dict = request_obj.args.to_dict()
+            request_dict.update({'payload': PayloadHandle.spool(request_obj.stream, request_obj.mimetype,
+                                                                cls.spool_dir)})
+            return request_dict
         if len(request_obj.data):
-            return json.loads(request_obj.data)
+            return (decoder or json.loads)(request_obj.data)
         else:
             return dict()
 
-    def __return_controller_func(self) -> any:
+    def __return_controller_func(self, method_name: str) -> any:
         """
         use the Resource class to run the _controller's http request method in flask-restful style
 
+        :param method_name: name of the http method, the same on the resource and the controller
         :return: any object that returned from _controller's http request method
         """
-        func = getattr(self._controller, inspect.currentframe().f_back.f_code.co_name)
+        func = getattr(self._controller, method_name)
         return func(**self._get_request_dict(request))
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_multiprocess_controller.schedule
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module implements the delay stage of MPController, holding the tickets submitted with `run_at` or `delay`
+    until they are due to enter the waiting queue.
+
+    :copyright: 2022 Yuhao Wang
+    :license: BSD-3-Clause
+"""
+
+import datetime
+import heapq
+import itertools
+import threading
+from typing import Dict, List, Optional, Tuple
+
+
+def parse_run_at(run_at) -> float:
+    """
+    :param run_at: epoch seconds, or an ISO 8601 date time (local time if it has no time zone)
+    :return: epoch seconds
+    """
+    if isinstance(run_at, str):
+        try:
+            return float(run_at)
+        except ValueError:
+            return datetime.datetime.fromisoformat(run_at).timestamp()
+    return float(run_at)
+
+
+class DelayQueue(object):
+    """
+    min-heap of the scheduled tickets by due time
+
+    a tick only looks at the head of the heap, removed tickets are left in the heap and skipped once they reach the
+    head, so that cancelling is O(1) as well
+    """
+
+    def __init__(self):
+        # (due time, sequence, key), the sequence keeps the order of submission among the tickets due at once
+        self._heap: List[Tuple[float, int, str]] = list()
+        self._due: Dict[str, float] = dict()
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._due
+
+    def due(self, key: str) -> Optional[float]:
+        return self._due.get(key)
+
+    def push(self, key: str, due: float) -> None:
+        with self._lock:
+            self._due.update({key: due})
+            heapq.heappush(self._heap, (due, next(self._sequence), key))
+
+    def remove(self, key: str) -> bool:
+        """
+        :param key: a scheduled ticket
+        :return: True if the ticket was scheduled, False if it has been removed or popped already
+        """
+        with self._lock:
+            return self._due.pop(key, None) is not None
+
+    def _skip_removed(self) -> None:
+        while self._heap and self._due.get(self._heap[0][2]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def next_due(self) -> Optional[float]:
+        """
+        :return: due time of the next ticket, None if nothing is scheduled
+        """
+        with self._lock:
+            self._skip_removed()
+            return self._heap[0][0] if self._heap else None
+
+    def pop(self, now: float) -> Optional[str]:
+        """
+        :param now: current time
+        :return: the next ticket due at now, None if no ticket is due
+        """
+        with self._lock:
+            self._skip_removed()
+            if not self._heap or self._heap[0][0] > now:
+                return None
+            key = heapq.heappop(self._heap)[2]
+            self._due.pop(key)
+            return key
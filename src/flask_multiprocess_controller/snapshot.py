@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_multiprocess_controller.snapshot
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module implements the local store of task snapshots, which lets the MPController resubmit a ticket that did
+    not finish (stopped, killed or interrupted by a restart) so that the task resumes from its last saved state.
+
+    :copyright: 2022 Yuhao Wang
+    :license: BSD-3-Clause
+"""
+
+import logging
+import os
+import pickle
+import time
+from typing import Iterable, List, Optional, Tuple
+
+from .payload import release_payloads
+from .utils import atomic_pickle_dump
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotStore(object):
+    """
+    snapshots kept in a state directory, for each snapshot key (the uuid of the ticket first submitted):
+    - `<key>.ticket`: the task class and the kwargs of the ticket, written when the ticket is dispatched
+    - `<key>.state`: the last state saved by the task, see MetaMPTask.save_state
+    - `<key>.scheduled`: the task class, the kwargs and the due time of a ticket submitted with `run_at` or `delay`,
+      until it enters the waiting queue
+    """
+
+    _TICKET_SUFFIX: str = '.ticket'
+    _STATE_SUFFIX: str = '.state'
+    _SCHEDULE_SUFFIX: str = '.scheduled'
+
+    def __init__(self, state_dir: str, ttl: float = None):
+        self.state_dir: str = state_dir
+        # snapshots not touched for ttl seconds are removed by collect, None to keep them forever
+        self.ttl: Optional[float] = ttl
+        os.makedirs(state_dir, exist_ok=True)
+
+    def state_path(self, key: str) -> str:
+        return os.path.join(self.state_dir, key + self._STATE_SUFFIX)
+
+    def _ticket_path(self, key: str) -> str:
+        return os.path.join(self.state_dir, key + self._TICKET_SUFFIX)
+
+    def save_ticket(self, key: str, target_task: type, kwargs: dict) -> None:
+        """
+        record what a ticket runs, so that it can be resumed after a restart of the controller
+        :param key: snapshot key of the ticket
+        :param target_task: task class of the ticket
+        :param kwargs: kwargs of the ticket
+        :return:
+        """
+        atomic_pickle_dump((target_task, kwargs), self._ticket_path(key))
+
+    def load_ticket(self, key: str) -> Optional[Tuple[type, dict]]:
+        """
+        :param key: snapshot key of the ticket
+        :return: (task class, kwargs) of the ticket, None if there is no snapshot for this key
+        """
+        try:
+            with open(self._ticket_path(key), 'rb') as ticket_file:
+                return pickle.load(ticket_file)
+        except FileNotFoundError:
+            return None
+
+    def _schedule_path(self, key: str) -> str:
+        return os.path.join(self.state_dir, key + self._SCHEDULE_SUFFIX)
+
+    def save_schedule(self, key: str, target_task: type, kwargs: dict, due: float) -> None:
+        """
+        record a scheduled ticket, so that it is scheduled again after a restart of the controller
+        :param key: uuid of the ticket
+        :param target_task: task class of the ticket
+        :param kwargs: kwargs of the ticket
+        :param due: time the ticket enters the waiting queue
+        :return:
+        """
+        atomic_pickle_dump((target_task, kwargs, due), self._schedule_path(key))
+
+    def discard_schedule(self, key: str) -> None:
+        try:
+            os.unlink(self._schedule_path(key))
+        except FileNotFoundError:
+            pass
+
+    def load_schedules(self) -> List[Tuple[str, type, dict, float]]:
+        """
+        :return: (uuid, task class, kwargs, due time) of every scheduled ticket recorded
+        """
+        schedules = list()
+        for file_name in os.listdir(self.state_dir):
+            if not file_name.endswith(self._SCHEDULE_SUFFIX):
+                continue
+            key = file_name[:-len(self._SCHEDULE_SUFFIX)]
+            try:
+                with open(self._schedule_path(key), 'rb') as schedule_file:
+                    schedules.append((key,) + pickle.load(schedule_file))
+            except Exception as e:
+                logger.warning("failed to load the scheduled ticket {}: {}".format(key, e))
+        return schedules
+
+    def discard(self, key: str) -> None:
+        """
+        remove the snapshot of a ticket that does not need to be resumed anymore
+        :param key: snapshot key of the ticket
+        :return:
+        """
+        for path in (self._ticket_path(key), self.state_path(key)):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def collect(self, active_keys: Iterable[str] = ()) -> None:
+        """
+        remove the snapshots not touched for ttl seconds, along with the payloads of their tickets
+        :param active_keys: keys of the tickets currently queued or running, never removed
+        :return:
+        """
+        if self.ttl is None:
+            return
+        active_keys = set(active_keys)
+        now = time.time()
+        for file_name in os.listdir(self.state_dir):
+            if not file_name.endswith(self._TICKET_SUFFIX):
+                continue
+            key = file_name[:-len(self._TICKET_SUFFIX)]
+            if key in active_keys:
+                continue
+            last_touched = max(os.path.getmtime(path) for path in (self._ticket_path(key), self.state_path(key))
+                               if os.path.exists(path))
+            if now - last_touched < self.ttl:
+                continue
+            try:
+                release_payloads(self.load_ticket(key)[1])
+            except Exception as e:
+                logger.warning("failed to release the payloads of snapshot {}: {}".format(key, e))
+            self.discard(key)
+            logger.info("stale snapshot {} removed".format(key))
@@ -12,11 +12,16 @@
 
 import logging
 import abc
+import multiprocessing
+import os
+import pickle
 from functools import wraps
-from multiprocessing import Event, Lock, Queue
+from multiprocessing import Event, Lock, Queue, TimeoutError
 from multiprocessing.connection import Connection
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from .dataset import DatasetHandle
 from .logger import MetaMPLoggerConfigurator
-from .utils import AbortException
+from .utils import ABORT_EXIT_CODE, AbortException, atomic_pickle_dump
 
 
 class MetaMPTask(metaclass=abc.ABCMeta):
@@ -32,8 +37,17 @@ class MetaMPTask(metaclass=abc.ABCMeta):
     task_name: str
     logger: logging.Logger
 
+    # environment variables read by OpenMP/BLAS runtimes to size their thread pools
+    _THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS')
+    # how often parallel_map/imap_unordered check the stop signal while waiting for sub-workers, in seconds
+    _SUB_WORKER_POLL_INTERVAL: float = 0.2
+
     def __init__(self, stop_event: Event, pipe_end: Connection, lock: Lock, queue: Queue, counter: int,
-                 log_configurator: type(MetaMPLoggerConfigurator)):
+                 log_configurator: type(MetaMPLoggerConfigurator),
+                 cpu_set: Tuple[int, ...] = None, num_threads: int = None, core_budget: int = None,
+                 datasets: Dict[str, DatasetHandle] = None, output_path: str = None,
+                 input_paths: Dict[str, str] = None, state_path: str = None,
+                 shard_index: int = None, num_shards: int = None, reduce_stage: bool = False):
 
         self._stop_event: Event = stop_event
         self._pipe_end: Connection = pipe_end
@@ -41,6 +55,24 @@ class MetaMPTask(metaclass=abc.ABCMeta):
         self._log_queue: Queue = queue
         self._log_configurator: type(MetaMPLoggerConfigurator) = log_configurator
         self.counter: int = counter
+        # placement decided by the controller, applied in the worker process before execute
+        self.cpu_set: Optional[Tuple[int, ...]] = cpu_set
+        self.num_threads: Optional[int] = num_threads
+        # number of cores this task may use, caps the sub-workers of parallel_map/imap_unordered
+        self.core_budget: int = core_budget if core_budget is not None else len(cpu_set or ()) or 1
+        # versions of the controller's shared datasets this task has been started with
+        self._datasets: Dict[str, DatasetHandle] = datasets or dict()
+        self._loaded_datasets: Dict[str, Any] = dict()
+        # where a pipeline stage saves its output and reads the outputs of its upstream stages
+        self._output_path: Optional[str] = output_path
+        self._input_paths: Dict[str, str] = input_paths or dict()
+        # snapshot of the task's state, kept by the controller until the task finishes, see save_state
+        self._state_path: Optional[str] = state_path
+        # position of this task in a sharded job, None if it is not a shard
+        self.shard_index: Optional[int] = shard_index
+        self.num_shards: Optional[int] = num_shards
+        # the reduce stage of a sharded job runs reduce over the outputs of the shards instead of execute
+        self._reduce_stage: bool = reduce_stage
 
         # set up the worker logger when init
         self._log_configurator.worker_log_setup(self._log_queue)
@@ -68,6 +100,174 @@ class MetaMPTask(metaclass=abc.ABCMeta):
         """
         pass
 
+    def run(self, *args, **kwargs) -> None:
+        """
+        entry point of the worker process, apply the placement then run execute
+        :param args: args to be passed to the execute method
+        :param kwargs: kwargs to be passed to the execute method
+        :return:
+        """
+        self._apply_placement()
+        self._lead_process_group()
+        if self._reduce_stage:
+            self._exception_catcher(MetaMPTask._gather)(self, *args, **kwargs)
+        else:
+            self.execute(*args, **kwargs)
+
+    def reduce(self, outputs: List[Any], *args, **kwargs) -> Any:
+        """
+        reduce step of a sharded job, run once every shard finished
+
+        override this method to combine the outputs of the shards, by default they are returned as is
+        :param outputs: outputs saved by the shards with save_output, in shard order, None for a shard saving nothing
+        :param args: args of the job
+        :param kwargs: kwargs of the job
+        :return: output of the job, saved as the output of the reduce stage
+        """
+        return outputs
+
+    def _gather(self, *args, **kwargs) -> None:
+        self.save_output(self.reduce(list(self.load_inputs().values()), *args, **kwargs))
+
+    def _apply_placement(self) -> None:
+        """
+        pin the worker process on its cpu set and limit the OpenMP/BLAS thread pools
+
+        the controller already starts the process with these settings, applying them again here covers the start
+        methods that do not inherit them from the controlling thread (e.g. forkserver)
+        :return:
+        """
+        if self.num_threads is not None:
+            os.environ.update({env_var: str(self.num_threads) for env_var in self._THREAD_ENV_VARS})
+        if self.cpu_set is not None:
+            try:
+                os.sched_setaffinity(0, self.cpu_set)
+            except (AttributeError, OSError) as e:
+                self.logger.warning("Task {}-{} failed to set cpu affinity {}: {}".format(
+                    self.task_name, self.counter, self.cpu_set, e))
+
+    def _lead_process_group(self) -> None:
+        """
+        move the worker process to a process group of its own, which its sub-workers join, so that the controller
+        stops, suspends and samples the task along with its sub-workers
+
+        the worker process is daemonic for the controller to end it along with itself, within the worker this flag
+        only forbids starting children, it is cleared so that the task may start its sub-workers
+        :return:
+        """
+        try:
+            os.setpgid(0, 0)
+        except (AttributeError, OSError) as e:
+            self.logger.warning("Task {}-{} failed to lead its process group: {}".format(
+                self.task_name, self.counter, e))
+        multiprocessing.current_process().daemon = False
+
+    def get_dataset(self, name: str) -> Any:
+        """
+        read-only, zero-copy access to a dataset registered on the controller, mapped on first access
+        :param name: name of the dataset
+        :return: read-only NumPy array for NumPy datasets, read-only memoryview otherwise
+        """
+        if name not in self._loaded_datasets:
+            if name not in self._datasets:
+                raise KeyError("Task {}-{} has no dataset {}.".format(self.task_name, self.counter, name))
+            self._loaded_datasets.update({name: self._datasets[name].load()})
+        return self._loaded_datasets[name]
+
+    def save_output(self, output: Any) -> None:
+        """
+        save the output of a pipeline stage for its downstream stages, the file is replaced atomically
+        :param output: picklable output
+        :return:
+        """
+        assert self._output_path is not None, \
+            "Task {}-{} is not a pipeline stage, it has no output.".format(self.task_name, self.counter)
+        atomic_pickle_dump(output, self._output_path)
+
+    def load_input(self, stage: str) -> Any:
+        """
+        load the output saved by an upstream stage of the pipeline
+        :param stage: name of the upstream stage
+        :return: the output, None if the upstream stage saved nothing
+        """
+        if stage not in self._input_paths:
+            raise KeyError("Task {}-{} has no upstream stage {}.".format(self.task_name, self.counter, stage))
+        if not os.path.exists(self._input_paths[stage]):
+            return None
+        with open(self._input_paths[stage], 'rb') as input_file:
+            return pickle.load(input_file)
+
+    def load_inputs(self) -> Dict[str, Any]:
+        """
+        :return: upstream stage name -> its output
+        """
+        return {stage: self.load_input(stage) for stage in self._input_paths}
+
+    def parallel_map(self, func: Callable, iterable: Iterable, chunksize: int = 1, processes: int = None,
+                     total: int = None) -> List[Any]:
+        """
+        apply func to every item of iterable in sub-worker processes, results are returned in order
+
+        the sub-workers are cancelled when the task receives the stop signal, and AbortException is raised
+        :param func: picklable function applied to each item
+        :param iterable: items to process
+        :param chunksize: number of items sent to a sub-worker at a time
+        :param processes: number of sub-workers, capped by the task's core budget
+        :param total: number of items, used to upload progress in percent when iterable has no len
+        :return: list of results
+        """
+        return list(self._iterate_sub_workers(func, iterable, chunksize, processes, total, ordered=True))
+
+    def imap_unordered(self, func: Callable, iterable: Iterable, chunksize: int = 1, processes: int = None,
+                       total: int = None) -> Iterator[Any]:
+        """
+        lazy version of parallel_map yielding results as soon as they are ready, in any order
+        :param func: picklable function applied to each item
+        :param iterable: items to process
+        :param chunksize: number of items sent to a sub-worker at a time
+        :param processes: number of sub-workers, capped by the task's core budget
+        :param total: number of items, used to upload progress in percent when iterable has no len
+        :return: iterator over the results
+        """
+        return self._iterate_sub_workers(func, iterable, chunksize, processes, total, ordered=False)
+
+    def _iterate_sub_workers(self, func: Callable, iterable: Iterable, chunksize: int, processes: Optional[int],
+                             total: Optional[int], ordered: bool) -> Iterator[Any]:
+        """
+        run func over iterable in a pool of sub-workers sharing the task's log queue, upload the progress and
+        watch the stop signal while waiting for results
+        :return: iterator over the results
+        """
+        processes = min(processes or self.core_budget, self.core_budget)
+        if total is None and hasattr(iterable, '__len__'):
+            total = len(iterable)
+        # sub-workers share the task's cores, one OpenMP/BLAS thread each
+        sub_worker_threads = self.num_threads if processes == 1 else 1
+        pool = multiprocessing.Pool(processes, initializer=_init_sub_worker,
+                                    initargs=(self._log_queue, self._log_configurator, sub_worker_threads))
+        try:
+            results = (pool.imap if ordered else pool.imap_unordered)(func, iterable, chunksize)
+            num_done, last_progress = 0, None
+            while True:
+                try:
+                    result = results.next(timeout=self._SUB_WORKER_POLL_INTERVAL)
+                except TimeoutError:
+                    self.set_checkpoint()
+                    continue
+                except StopIteration:
+                    break
+                num_done += 1
+                progress = num_done * 100 // total if total else num_done
+                if progress != last_progress:
+                    self.upload_status(progress)
+                    last_progress = progress
+                yield result
+                self.set_checkpoint()
+        finally:
+            # cancel the chunks still pending, including when the stop signal is raised
+            pool.terminate()
+            pool.join()
+
     def _abort_log(self, logger: logging.Logger) -> None:
         """
         standard log when received the stop signal
@@ -88,11 +288,34 @@ class MetaMPTask(metaclass=abc.ABCMeta):
         finally:
             self._lock.release()
 
-    def set_checkpoint(self) -> None:
+    def save_state(self, state: Any) -> None:
+        """
+        snapshot the state of the task, a resumed ticket gets it back by load_state
+
+        the snapshot is replaced atomically, does nothing if the controller has no state_dir
+        :param state: picklable state
+        :return:
+        """
+        if self._state_path is not None:
+            atomic_pickle_dump(state, self._state_path)
+
+    def load_state(self) -> Any:
+        """
+        :return: the last state saved by the ticket this task resumes, None when starting from scratch
+        """
+        if self._state_path is None or not os.path.exists(self._state_path):
+            return None
+        with open(self._state_path, 'rb') as state_file:
+            return pickle.load(state_file)
+
+    def set_checkpoint(self, state: Any = None) -> None:
         """
         check the stop signal, if met raise AbortException and exit gently
+        :param state: if specified, snapshot it by save_state before checking the stop signal
         :return:
         """
+        if state is not None:
+            self.save_state(state)
         if self._stop_event.is_set():
             raise AbortException("Task {}-{} aborted by signal.".format(self.task_name, self.counter))
 
@@ -104,6 +327,24 @@ class MetaMPTask(metaclass=abc.ABCMeta):
                 execute(*args, **kwargs)
             except AbortException as ae:
                 cls.logger.info(ae)
+                # distinct exit code to let the controller tell a stopped task from one that finished meanwhile
+                raise SystemExit(ABORT_EXIT_CODE)
             except Exception as e:
                 cls.logger.critical(e)
+                # non-zero exit code to let the controller record the task as failed
+                raise SystemExit(1)
         return with_exception_catcher_execute
+
+
+def _init_sub_worker(log_queue: Queue, log_configurator: type(MetaMPLoggerConfigurator),
+                     num_threads: Optional[int]) -> None:
+    """
+    initializer of the sub-workers started by MetaMPTask.parallel_map/imap_unordered
+    :param log_queue: the task's log queue
+    :param log_configurator: the task's log configurator
+    :param num_threads: OpenMP/BLAS thread count of the sub-worker, None to inherit the task's settings
+    :return:
+    """
+    if num_threads is not None:
+        os.environ.update({env_var: str(num_threads) for env_var in MetaMPTask._THREAD_ENV_VARS})
+    log_configurator.worker_log_setup(log_queue)
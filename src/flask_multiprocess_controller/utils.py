@@ -11,12 +11,17 @@
 
 import json
 import logging
-import requests
+import os
+import pickle
 from multiprocessing import Lock, Event
 from multiprocessing.connection import Connection
+from typing import Any, Dict, Iterable, List, Optional
 
 logger = logging.getLogger(__name__)
 
+# exit code of a task process that stopped at a checkpoint on the stop signal, apart from finishing (0) or failing (1)
+ABORT_EXIT_CODE = 3
+
 
 class AbortException(BaseException):
     """
@@ -56,9 +61,109 @@ def set_checkpoint(stop_event: Event, task_name: str, counter: int = None) -> No
         raise AbortException(exception_str)
 
 
+def atomic_pickle_dump(obj: Any, path: str) -> None:
+    """
+    pickle an object to a file atomically, readers see either the previous content or the new one
+    :param obj: picklable object
+    :param path: destination file
+    :return:
+    """
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(temp_path, 'wb') as temp_file:
+            pickle.dump(obj, temp_file, protocol=pickle.HIGHEST_PROTOCOL)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+
+def get_process_rss(pid: int) -> Optional[int]:
+    """
+    read the resident set size of a process from /proc/<pid>/statm
+    :param pid: the process to sample
+    :return: resident set size in bytes, None if the process is gone or /proc is not available
+    """
+    try:
+        with open('/proc/{}/statm'.format(pid), 'rb') as statm:
+            resident_pages = int(statm.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident_pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def get_process_groups(pgids: Iterable[int]) -> Dict[int, List[int]]:
+    """
+    list the members of process groups from /proc/<pid>/stat, scanning /proc once for all the groups
+    :param pgids: ids of the process groups, a task process leads the group of its sub-workers
+    :return: process group id -> pids of its members, empty lists if /proc is not available
+    """
+    members = {pgid: list() for pgid in pgids}
+    try:
+        pids = [int(entry) for entry in os.listdir('/proc') if entry.isdigit()]
+    except OSError:
+        return members
+    for pid in pids:
+        try:
+            with open('/proc/{}/stat'.format(pid), 'rb') as stat:
+                # the fields after the command name, which may contain spaces: state, ppid, pgrp, ...
+                pgid = int(stat.read().rsplit(b')', 1)[1].split()[2])
+        except (OSError, IndexError, ValueError):
+            continue
+        if pgid in members:
+            members[pgid].append(pid)
+    return members
+
+
+def get_process_group_rss(pgid: int, members: List[int] = None) -> Optional[int]:
+    """
+    :param pgid: a process leading its process group
+    :param members: pids of the group, see get_process_groups, the leader alone if not specified or empty
+    :return: sum of the resident set sizes of the group in bytes, None if none of them could be sampled
+    """
+    rss_list = [rss for rss in (get_process_rss(pid) for pid in members or [pgid]) if rss is not None]
+    return sum(rss_list) if rss_list else None
+
+
+def signal_process_group(pid: int, signal_number: int) -> None:
+    """
+    send a signal to a task process and its sub-workers, i.e. the process group it leads, or to the process alone
+    if it does not lead a group (yet)
+    :param pid: the task process
+    :param signal_number: the signal to send
+    :return:
+    """
+    try:
+        os.killpg(pid, signal_number)
+    except ProcessLookupError:
+        try:
+            os.kill(pid, signal_number)
+        except ProcessLookupError:
+            pass
+
+
+def shorten_repr(obj, max_length: int = None) -> str:
+    """
+    repr of an object truncated for logging
+    :param obj: object to represent
+    :param max_length: max number of characters, None for no limit
+    :return:
+    """
+    obj_repr = repr(obj)
+    if max_length is None or len(obj_repr) <= max_length:
+        return obj_repr
+    return '{}...<{} more chars>'.format(obj_repr[:max_length], len(obj_repr) - max_length)
+
+
 def send_request(url, data, callback_loop: int = 3,
                  callback_header=None, callback_timeout: int = 60):
 
+    # imported here so that the workers, which import this module as well, never load requests
+    import requests
+
     if callback_header is None:
         callback_header = {'Content-Type': 'application/json'}
     update_flag = True